@@ -1,16 +1,22 @@
 
 import os
-import re
 import shutil
+import argparse
+import queue
+import threading
 from pathlib import Path
 import pandas as pd
 from tkinter import Tk, filedialog, simpledialog
 from reference_search_module_allpoints_250709 import run_misorientation_matching_all_vs_targets
-from visualize_grain_map_overlay_250709 import visualize_grain_map  # 同じディレクトリに必要
+from visualize_grain_map_overlay_250709 import (  # 同じディレクトリに必要
+    default_save_path, load_grain_map, render_grain_map_task, render_grain_maps_parallel,
+    headless_render_pool)
 from tkinter import Tk, Label, Button
 from tkinter import ttk
 from scipy.spatial.transform import Rotation as R
-from preprocessed_loader import load_preprocessed_xlsx, load_preprocessed_mat, get_value_by_label
+from results_store import append_match_results
+from pattern_similarity import TIF_COORD_PATTERN, build_tif_coord_map, closest_tif
+from preprocessed_loader import load_preprocessed_xlsx, load_preprocessed_mat, read_project_details
 
 def select_folder(prompt, initialdir=None):
     print(prompt)
@@ -39,25 +45,6 @@ def select_multiple_folders_manual(prompt="処理対象の nth フォルダを1
     print(f"✔ 選択された nth フォルダ: {[f.name for f in folders]}")
     return folders
 
-def find_closest_tif(x, y, coord_map):
-    min_dist = float('inf')
-    closest_file = None
-    for (cx, cy), file in coord_map.items():
-        dist = (cx - x)**2 + (cy - y)**2
-        if dist < min_dist:
-            min_dist = dist
-            closest_file = file
-    return closest_file
-
-# === Step 0: フォルダを選択 ===
-print("🗂 0th フォルダが含まれる親フォルダを選択してください")
-parent_folder = select_folder("0th を含む親フォルダを選択")
-folder_0th = parent_folder / "0th"
-
-print("🗂 nth フォルダを1つずつ選択してください（キャンセルで終了）")
-folders_nth = select_multiple_folders_manual("処理対象の nth フォルダを1つずつ選択（キャンセルで終了）")
-
-# === Step 1: しきい値の入力,  対称性の選択（全体共通） ===
 def get_symmetry_ops():
     sym_options = [
         ("cubic", "O"),
@@ -98,120 +85,286 @@ def get_symmetry_ops():
     label, group = sym_options[idx]
     sym_ops = R.create_group(group).as_matrix()
     print(f"✅ 選択された対称性: '{label}' → group '{group}', 操作数: {len(sym_ops)}")
-    return sym_ops
-
-# ── Phaseごとに対称性を選択 ───────────────
-mat0_dict      = load_preprocessed_mat(str(parent_folder), '0th')
-phase_idx_map  = mat0_dict['phase_index']
-phase_names    = [str(n) for n in mat0_dict['phasetxt'][0]]
-phases = sorted(set(map(int, phase_idx_map.flatten())))
-phase_sym_map  = {}
-for idx in phases:
-    name = phase_names[idx]
-    print(f"🧩 Phase '{name}' (index {idx}) の対称性を選択中…")
-    phase_sym_map[idx] = get_symmetry_ops()
-# ──────────────────────────────────
-
-root = Tk()
-root.withdraw()
-angle_threshold = simpledialog.askfloat("Misorientation Threshold", "Max misorientation angle (deg):", initialvalue=5.0)
-
-# === Step 2: 各 nth フォルダに対して処理を実行 ===
-visualization_targets = []  # 後でまとめて可視化
-for folder_nth in folders_nth:
-    try:
-        parent_dir = folder_nth.parent
-        nth_name = folder_nth.name
-
-        mat_0th = folder_0th.parent / "pre-processed 0th.mat"
-        mat_nth = folder_nth.parent / f"pre-processed {nth_name}.mat"
-        excel_nth = folder_nth.parent / f"pre-processed {nth_name}.xlsx"
-
-        if not (mat_0th.exists() and mat_nth.exists() and excel_nth.exists()):
-            print(f"❌ {nth_name}: 必要な .mat または .xlsx ファイルが見つかりません")
-            continue
-
-        replacing_dir = parent_dir / f"replacing_0th_{nth_name}"
-        renamed_dir = parent_dir / f"renamed_0th_{nth_name}"
-        replaced_dir = parent_dir / f"replaced_{nth_name}"
-        for folder in [replacing_dir, renamed_dir, replaced_dir]:
-            folder.mkdir(exist_ok=True)
-
-        print(f"🔍 {nth_name}: misorientation を計算中...")
-        csv_path = parent_dir / f"replaced pattern list 0th_{nth_name}.csv"
-        # ── Phase別 misorientation 計算 ─────────
-        dfs = []
-        for idx in phases:
-            phase_name = phase_names[idx]
-            print(f"🔍 {nth_name}: Phase '{phase_name}' の misorientation を計算中…")
-            # Count reference points for this phase
-            from reference_search_module_allpoints_250709 import extract_target_points
-            target_list = extract_target_points(str(excel_nth), str(mat_nth))
-            count_ref = len(target_list[target_list['phase'] == idx])
-            print(f"Phase {idx} ({phase_names[idx]}): {count_ref} reference points to process")
-            df_phase = run_misorientation_matching_all_vs_targets(
-                mat_0th_path=str(mat_0th),
-                sym_ops=phase_sym_map[idx],
-                excel_nth_path=str(excel_nth),
-                mat_nth_path=str(mat_nth),
-                output_csv=None,
-                tif_dir=str(folder_0th),
-                angle_threshold=angle_threshold,
-                target_phase=idx,
-            )
-            df_phase['phase'] = phase_name
-            dfs.append(df_phase)
-        df = pd.concat(dfs, ignore_index=True)
-        # ──────────────────────────────────
-
-        df_excel = pd.read_excel(excel_nth, sheet_name="Project Details", header=None)
-        n_ref = int(get_value_by_label(df_excel, "Number of References"))
-        matched_names = set(df["Deformed_Filename"])
-        all_targets = set(df_excel.iloc[31:31+n_ref, 1].dropna().str.extract(r'(^.+\.tif)')[0])
-        unmatched = sorted(all_targets - matched_names)
-
-        with open(csv_path, "w", encoding="utf-8") as f:
-            f.write(f"# angle_threshold: {angle_threshold}\n")
-            f.write(f"# number_of_references: {n_ref}\n")
-            f.write(f"# number_of_matched_patterns: {len(df)}\n")
-            f.write("# no_matched_patterns: \"" + " ".join(unmatched) + "\"\n")
-            df.to_csv(f, index=False, lineterminator="\n")
-
-        print(f"📂 {nth_name}: ファイルをコピー・置換します...")
-        tif_files = list(folder_0th.glob("*.tif"))
-        coord_map = {}
-        pattern = re.compile(r"x(\d+)y(\d+)")
-        for f in tif_files:
-            match = pattern.search(f.name)
-            if match:
-                x, y = int(match.group(1)), int(match.group(2))
-                coord_map[(x, y)] = f
-
-        for _, row in df.iterrows():
-            matched_name = row["Matched_0th_Filename"]
-            deformed_name = row["Deformed_Filename"]
-            match = pattern.search(matched_name)
-            if match:
-                x, y = int(match.group(1)), int(match.group(2))
-                matched_file = find_closest_tif(x, y, coord_map)
-                if matched_file is None:
-                    print(f"⚠ {matched_name} に近いファイルが見つかりません。スキップします。")
-                    continue
-                shutil.copy2(matched_file, replacing_dir / matched_file.name)
-                shutil.copy2(matched_file, renamed_dir / deformed_name)
-                nth_path = folder_nth / deformed_name
-                if nth_path.exists():
-                    shutil.copy2(nth_path, replaced_dir / deformed_name)
-                shutil.copy2(renamed_dir / deformed_name, nth_path)
-
-        visualization_targets.append((mat_nth, excel_nth, csv_path, nth_name))
-
-        print(f"✅ {nth_name}: 処理完了。\n")
-
-    except Exception as e:
-        print(f"❗ {folder_nth.name}: エラーが発生しました → {e}")
-
-# === Step 6: マップ可視化を一括実行 ===
-for mat_nth, excel_nth, csv_path, nth_name in visualization_targets:
-    print(f"🖼 {nth_name}: グレインマップを表示・保存中...")
-    visualize_grain_map(str(mat_nth), str(excel_nth), str(csv_path))
+    return label, sym_ops
+
+def match_nth_folder(folder_nth):
+    """misorientation マッチングを行い CSV を書き出す。後段に渡すジョブ dict を返す（対象外なら None）"""
+    parent_dir = folder_nth.parent
+    nth_name = folder_nth.name
+
+    mat_0th = folder_0th.parent / "pre-processed 0th.mat"
+    mat_nth = folder_nth.parent / f"pre-processed {nth_name}.mat"
+    excel_nth = folder_nth.parent / f"pre-processed {nth_name}.xlsx"
+
+    if not (mat_0th.exists() and mat_nth.exists() and excel_nth.exists()):
+        print(f"❌ {nth_name}: 必要な .mat または .xlsx ファイルが見つかりません")
+        return None
+
+    replacing_dir = parent_dir / f"replacing_0th_{nth_name}"
+    renamed_dir = parent_dir / f"renamed_0th_{nth_name}"
+    replaced_dir = parent_dir / f"replaced_{nth_name}"
+    for folder in [replacing_dir, renamed_dir, replaced_dir]:
+        folder.mkdir(exist_ok=True)
+
+    print(f"🔍 {nth_name}: misorientation を計算中...")
+    csv_path = parent_dir / f"replaced pattern list 0th_{nth_name}.csv"
+    # ── Phase別 misorientation 計算 ─────────
+    dfs = []
+    # Count reference points per phase (参照点リストは全Phase共通なので1回だけ抽出)
+    from reference_search_module_allpoints_250709 import extract_target_points
+    target_list = extract_target_points(str(excel_nth), str(mat_nth))
+    for idx in phases:
+        phase_name = phase_names[idx]
+        print(f"🔍 {nth_name}: Phase '{phase_name}' の misorientation を計算中…")
+        count_ref = len(target_list[target_list['phase'] == idx])
+        print(f"Phase {idx} ({phase_names[idx]}): {count_ref} reference points to process")
+        df_phase = run_misorientation_matching_all_vs_targets(
+            mat_0th_path=str(mat_0th),
+            sym_ops=phase_sym_map[idx],
+            excel_nth_path=str(excel_nth),
+            mat_nth_path=str(mat_nth),
+            output_csv=None,
+            tif_dir=str(folder_0th),
+            angle_threshold=angle_threshold,
+            target_phase=idx,
+            verify_patterns=args.verify_patterns,
+            # 置換済みフォルダを再処理する場合に備え、退避済みの元パターンを優先
+            deformed_tif_dirs=[replaced_dir, folder_nth],
+            verify_top_k=args.verify_top_k,
+            ncc_threshold=args.ncc_threshold,
+            verify_workers=args.verify_workers,
+            coord_map=coord_map,
+        )
+        df_phase['phase'] = phase_name
+        dfs.append(df_phase)
+    df = pd.concat(dfs, ignore_index=True)
+    # ──────────────────────────────────
+
+    details = read_project_details(excel_nth)
+    n_ref = details.n_references
+    matched_names = set(df["Deformed_Filename"])
+    all_targets = set(details.reference_filenames)
+    unmatched = sorted(all_targets - matched_names)
+
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write(f"# angle_threshold: {angle_threshold}\n")
+        f.write(f"# number_of_references: {n_ref}\n")
+        f.write(f"# number_of_matched_patterns: {len(df)}\n")
+        f.write("# no_matched_patterns: \"" + " ".join(unmatched) + "\"\n")
+        df.to_csv(f, index=False, lineterminator="\n")
+
+    if args.results_store:
+        append_match_results(args.results_store, nth_name, df,
+                             angle_threshold=angle_threshold,
+                             phase_symmetry=phase_sym_labels,
+                             number_of_references=n_ref,
+                             unmatched=unmatched)
+
+    return {
+        "nth_name": nth_name,
+        "folder_nth": folder_nth,
+        "mat_nth": mat_nth,
+        "excel_nth": excel_nth,
+        "csv_path": csv_path,
+        "df": df,
+        # マップ描画用に grain_number だけ読んでおく（描画段で .mat / CSV を読み直さない）
+        "grain_id": load_grain_map(str(mat_nth)),
+        "replacing_dir": replacing_dir,
+        "renamed_dir": renamed_dir,
+        "replaced_dir": replaced_dir,
+    }
+
+def transfer_matched_tifs(job):
+    """マッチした 0th の tif をコピーし、nth フォルダのパターンを置換する"""
+    print(f"📂 {job['nth_name']}: ファイルをコピー・置換します...")
+    for _, row in job["df"].iterrows():
+        matched_name = row["Matched_0th_Filename"]
+        deformed_name = row["Deformed_Filename"]
+        match = TIF_COORD_PATTERN.search(matched_name)
+        if match:
+            x, y = int(match.group(1)), int(match.group(2))
+            matched_file = closest_tif(x, y, coord_map)
+            if matched_file is None:
+                print(f"⚠ {matched_name} に近いファイルが見つかりません。スキップします。")
+                continue
+            shutil.copy2(matched_file, job["replacing_dir"] / matched_file.name)
+            shutil.copy2(matched_file, job["renamed_dir"] / deformed_name)
+            nth_path = job["folder_nth"] / deformed_name
+            if nth_path.exists():
+                shutil.copy2(nth_path, job["replaced_dir"] / deformed_name)
+            shutil.copy2(job["renamed_dir"] / deformed_name, nth_path)
+
+def make_render_task(job):
+    return {
+        "grain_id": job["grain_id"],
+        "references": read_project_details(job["excel_nth"]).references_frame(),
+        "matched_filenames": set(job["df"]["Deformed_Filename"]) if len(job["df"]) else set(),
+        "save_path": default_save_path(str(job["mat_nth"])),
+        "preview_dpi": args.preview_dpi,
+    }
+
+def render_matching_map(job, show=True):
+    print(f"🖼 {job['nth_name']}: グレインマップを表示・保存中...")
+    render_grain_map_task(make_render_task(job), show=show)
+
+def render_matching_maps_headless(jobs):
+    """全ステップのマップをプロセスプールで画面表示なしに保存する"""
+    print(f"🖼 {len(jobs)} ステップのグレインマップを並列に保存中...")
+    results = render_grain_maps_parallel([make_render_task(job) for job in jobs],
+                                         max_workers=args.render_workers)
+    for job, (save_path, error) in zip(jobs, results):
+        if error is None:
+            print(f"✅ {job['nth_name']}: {save_path}")
+        else:
+            print(f"❗ {job['nth_name']}: マップ描画でエラーが発生しました → {error}")
+
+def run_sequential(folders_nth):
+    visualization_targets = []  # 後でまとめて可視化
+    for folder_nth in folders_nth:
+        try:
+            job = match_nth_folder(folder_nth)
+            if job is None:
+                continue
+            transfer_matched_tifs(job)
+            visualization_targets.append(job)
+            print(f"✅ {job['nth_name']}: 処理完了。\n")
+        except Exception as e:
+            print(f"❗ {folder_nth.name}: エラーが発生しました → {e}")
+
+    # === Step 6: マップ可視化を一括実行 ===
+    if args.headless_render:
+        render_matching_maps_headless(visualization_targets)
+        return
+    for job in visualization_targets:
+        render_matching_map(job)
+
+def run_pipelined(folders_nth, queue_size=2, render_workers=None):
+    """
+    マッチング（メインスレッド）、tif 転送（スレッド）、マップ描画（プロセスプール）を並行実行する。
+    フォルダ k+1 のマッチング中に、k の転送と描画（画面表示なしで保存）が進む。
+    描画は CPU を使うので、マッチングと GIL を取り合わないよう別プロセスで行う。
+    """
+    transfer_q = queue.Queue(maxsize=queue_size)
+    done = object()
+    status = {f.name: {"match": "pending", "transfer": "pending", "render": "pending"} for f in folders_nth}
+    status_lock = threading.Lock()
+
+    def finish(name, stage, result):
+        with status_lock:
+            status[name][stage] = result
+            if all(v == "ok" for v in status[name].values()):
+                print(f"✅ {name}: 処理完了。\n")
+
+    def transfer_worker():
+        while True:
+            job = transfer_q.get()
+            if job is done:
+                return
+            name = job["nth_name"]
+            try:
+                transfer_matched_tifs(job)
+                finish(name, "transfer", "ok")
+            except Exception as e:
+                print(f"❗ {name}: tif 転送でエラーが発生しました → {e}")
+                finish(name, "transfer", f"error: {e}")
+
+    def on_rendered(name, fut):
+        try:
+            fut.result()
+            finish(name, "render", "ok")
+        except Exception as e:
+            print(f"❗ {name}: マップ描画でエラーが発生しました → {e}")
+            finish(name, "render", f"error: {e}")
+
+    transfer_thread = threading.Thread(target=transfer_worker, daemon=True)
+    transfer_thread.start()
+
+    with headless_render_pool(render_workers) as render_pool:
+        for folder_nth in folders_nth:
+            name = folder_nth.name
+            try:
+                job = match_nth_folder(folder_nth)
+            except Exception as e:
+                status[name].update(match=f"error: {e}", transfer="skipped", render="skipped")
+                print(f"❗ {name}: エラーが発生しました → {e}")
+                continue
+            if job is None:
+                status[name].update(match="skipped", transfer="skipped", render="skipped")
+                continue
+            finish(name, "match", "ok")
+            # 描画は CSV と .mat/.xlsx の内容だけを使うので転送とは独立に投げる
+            print(f"🖼 {name}: グレインマップを保存中...")
+            fut = render_pool.submit(render_grain_map_task, make_render_task(job))
+            fut.add_done_callback(lambda f, name=name: on_rendered(name, f))
+            transfer_q.put(job)  # キューが満杯なら転送が追いつくまで待つ
+
+        transfer_q.put(done)
+        transfer_thread.join()
+    # with を抜けた時点で描画もすべて終わっている
+
+    print("=== フォルダごとの結果 ===")
+    for name, st in status.items():
+        print(f"{name}: match={st['match']}, transfer={st['transfer']}, render={st['render']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipeline", action="store_true",
+                        help="マッチング・tif 転送・マップ描画を並行実行する（マップは表示せず保存のみ）")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="パイプライン各段の間のキュー長 (default: 2)")
+    parser.add_argument("--results-store", type=str, default="",
+                        help="マッチング結果と実行条件を追記する Parquet ストアのフォルダ（CSV も従来通り出力）")
+    parser.add_argument("--verify-patterns", action="store_true",
+                        help="IQ 上位の候補 tif を変形パターンと正規化相互相関で比較し、最も似た候補を採用する")
+    parser.add_argument("--verify-top-k", type=int, default=5,
+                        help="パターン検証する候補数 (default: 5)")
+    parser.add_argument("--ncc-threshold", type=float, default=None,
+                        help="NCC がこの値未満の候補は置換しない（未指定なら除外しない）")
+    parser.add_argument("--verify-workers", type=int, default=None,
+                        help="パターン検証のスレッド数（未指定なら自動）")
+    parser.add_argument("--headless-render", action="store_true",
+                        help="最後のマップ描画をプロセスプールで並列に行い、表示せず保存のみ行う（--pipeline では常にこの動作）")
+    parser.add_argument("--render-workers", type=int, default=None,
+                        help="マップ描画のプロセス数（未指定なら CPU 数。--pipeline でも有効）")
+    parser.add_argument("--preview-dpi", type=int, default=None,
+                        help="指定すると 300 dpi の画像に加えて低解像度プレビュー (*_preview.png) も保存する")
+    args = parser.parse_args()
+
+    # === Step 0: フォルダを選択 ===
+    print("🗂 0th フォルダが含まれる親フォルダを選択してください")
+    parent_folder = select_folder("0th を含む親フォルダを選択")
+    folder_0th = parent_folder / "0th"
+
+    print("🗂 nth フォルダを1つずつ選択してください（キャンセルで終了）")
+    folders_nth = select_multiple_folders_manual("処理対象の nth フォルダを1つずつ選択（キャンセルで終了）")
+
+    # === Step 1: しきい値の入力,  対称性の選択（全体共通） ===
+    # ── Phaseごとに対称性を選択 ───────────────
+    mat0_dict      = load_preprocessed_mat(str(parent_folder), '0th',
+                                           variable_names=['phase_index', 'phasetxt'])
+    phase_idx_map  = mat0_dict['phase_index']
+    phase_names    = [str(n) for n in mat0_dict['phasetxt'][0]]
+    phases = sorted(set(map(int, phase_idx_map.flatten())))
+    phase_sym_map  = {}
+    phase_sym_labels = {}
+    for idx in phases:
+        name = phase_names[idx]
+        print(f"🧩 Phase '{name}' (index {idx}) の対称性を選択中…")
+        phase_sym_labels[name], phase_sym_map[idx] = get_symmetry_ops()
+    # ──────────────────────────────────
+
+    root = Tk()
+    root.withdraw()
+    angle_threshold = simpledialog.askfloat("Misorientation Threshold", "Max misorientation angle (deg):", initialvalue=5.0)
+
+    # === Step 2: nth フォルダごとの処理（マッチング → tif 転送 → マップ描画） ===
+    # 0th の tif 座標マップは全 nth フォルダ共通なので1回だけ作る
+    coord_map = build_tif_coord_map(folder_0th)
+
+    if args.pipeline:
+        if args.headless_render:
+            print("ℹ --pipeline ではマップは常にプロセスプールで保存のみ行うため、--headless-render の指定は不要です")
+        run_pipelined(folders_nth, queue_size=args.queue_size, render_workers=args.render_workers)
+    else:
+        run_sequential(folders_nth)
+
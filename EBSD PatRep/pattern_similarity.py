@@ -0,0 +1,105 @@
+
+# 置換候補パターンと変形パターンの類似度（FFT 正規化相互相関）による検証モジュール
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+
+TIF_COORD_PATTERN = re.compile(r"x(\d+)y(\d+)")
+
+# 0th パターンのデコード結果キャッシュ（同じ 0th 点は多くのターゲットの候補になる）
+REFERENCE_CACHE_SIZE = 4096
+
+def build_tif_coord_map(tif_dir):
+    """tif_dir 内の "x<col>y<row>" 形式の tif を {(x, y): Path} にまとめる"""
+    coord_map = {}
+    for f in Path(tif_dir).glob("*.tif"):
+        m = TIF_COORD_PATTERN.search(f.name)
+        if m:
+            coord_map[(int(m.group(1)), int(m.group(2)))] = f
+    return coord_map
+
+def closest_tif(x, y, coord_map):
+    f = coord_map.get((x, y))
+    if f is not None:
+        return f
+    min_dist = float('inf')
+    closest_file = None
+    for (cx, cy), file in coord_map.items():
+        dist = (cx - x)**2 + (cy - y)**2
+        if dist < min_dist:
+            min_dist = dist
+            closest_file = file
+    return closest_file
+
+def preprocess_pattern(img, downsample=4, background_sigma=8.0):
+    """
+    パターンを縮小（ブロック平均）し、ガウシアンで推定した背景で割って
+    平均0・標準偏差1に正規化する（float32）。
+    """
+    img = np.asarray(img, dtype=np.float32)
+    if img.ndim == 3:
+        img = img[..., :3].mean(axis=2)
+    if downsample > 1:
+        h = img.shape[0] // downsample * downsample
+        w = img.shape[1] // downsample * downsample
+        img = img[:h, :w].reshape(h // downsample, downsample, w // downsample, downsample).mean(axis=(1, 3))
+    if background_sigma:
+        background = gaussian_filter(img, background_sigma)
+        img = img / np.maximum(background, 1e-6)
+    img = img - img.mean()
+    std = img.std()
+    return img / std if std > 0 else img
+
+def load_pattern(path, downsample=4, background_sigma=8.0):
+    with Image.open(path) as im:
+        return preprocess_pattern(np.array(im), downsample, background_sigma)
+
+@lru_cache(maxsize=REFERENCE_CACHE_SIZE)
+def load_reference_pattern(path, downsample=4, background_sigma=8.0):
+    return load_pattern(path, downsample, background_sigma)
+
+def batched_ncc(target, candidates, max_shift=2):
+    """
+    target (H, W) と candidates (K, H, W) の正規化相互相関を FFT でまとめて計算し、
+    ±max_shift px 以内のずれに対する最大値（-1..1）を候補ごとに返す（max_shift=0 ならずれなし）。
+    巡回相関の回り込みを避けるため max_shift 分ゼロ詰めしてから FFT する。
+    入力は preprocess_pattern 済み（平均0・標準偏差1）を想定。
+    """
+    h = min(target.shape[0], candidates.shape[1])
+    w = min(target.shape[1], candidates.shape[2])
+    target = target[:h, :w]
+    candidates = candidates[:, :h, :w]
+    s = (h + max_shift, w + max_shift)
+    f_target = np.fft.rfft2(target, s=s)
+    f_cand = np.fft.rfft2(candidates, s=s, axes=(1, 2))
+    corr = np.fft.irfft2(f_cand * np.conj(f_target), s=s, axes=(1, 2))
+    # ずれ 0..+max_shift は先頭、-max_shift..-1 は末尾に入っている
+    lags_r = np.r_[0:max_shift + 1, s[0] - max_shift:s[0]]
+    lags_c = np.r_[0:max_shift + 1, s[1] - max_shift:s[1]]
+    window = corr[:, lags_r][:, :, lags_c]
+    return window.reshape(len(candidates), -1).max(axis=1) / (h * w)
+
+def rank_candidates(deformed_path, candidate_paths, downsample=4, background_sigma=8.0, max_shift=2):
+    """候補 tif ごとの NCC を返す（candidate_paths と同じ順）"""
+    target = load_pattern(deformed_path, downsample, background_sigma)
+    cands = np.stack([load_reference_pattern(str(p), downsample, background_sigma) for p in candidate_paths])
+    return batched_ncc(target, cands, max_shift=max_shift)
+
+def verify_jobs(jobs, max_workers=None, downsample=4, background_sigma=8.0, max_shift=2):
+    """
+    jobs: [(deformed_path, [candidate_path, ...]), ...] をスレッドプールで検証し、
+    各ジョブの NCC 配列（失敗時は None）を同じ順で返す。
+    """
+    def run(job):
+        deformed_path, candidate_paths = job
+        try:
+            return rank_candidates(deformed_path, candidate_paths, downsample, background_sigma, max_shift)
+        except Exception as e:
+            print(f"⚠ パターン検証に失敗しました ({Path(deformed_path).name}) → {e}")
+            return None
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(run, jobs))
@@ -1,9 +1,19 @@
 import os
 import glob
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import scipy.io as sio
 import re
 
+# "Project Details" シートの参照パターン行: "<filename>.tif,<index>"
+_REFERENCE_LINE = re.compile(r"(^.+\.tif),(\d+)$")
+
+# MATLAB v7.3 の .mat は 512 バイトのユーザーブロックに続く HDF5 ファイル
+_HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
 def load_preprocessed_xlsx(folder: str, nth: str, **read_excel_kwargs) -> pd.DataFrame:
     pattern = os.path.join(folder, f"pre-processed {nth}*.xlsx")
     candidates = glob.glob(pattern)
@@ -12,13 +22,58 @@ def load_preprocessed_xlsx(folder: str, nth: str, **read_excel_kwargs) -> pd.Dat
     path = sorted(candidates)[0]
     return pd.read_excel(path, **read_excel_kwargs)
 
-def load_preprocessed_mat(folder: str, nth: str) -> dict:
+def is_v73_mat(path: str) -> bool:
+    """
+    Return True if the .mat file is a MATLAB v7.3 (HDF5-based) file.
+    """
+    with open(path, "rb") as f:
+        head = f.read(520)
+    return head[:8] == _HDF5_SIGNATURE or head[512:520] == _HDF5_SIGNATURE
+
+def _read_h5_variable(h5file, obj):
+    """
+    Read one v7.3 variable and return it transposed to MATLAB's (row, col) order,
+    the same layout as scipy.io.loadmat.
+    """
+    matlab_class = obj.attrs.get("MATLAB_class", b"")
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode()
+    data = obj[()]
+    if matlab_class == "char":
+        # uint16 の文字コード列 → loadmat と同様に str の配列で返す
+        return np.array(["".join(chr(c) for c in np.ravel(data.T, order="F"))])
+    if matlab_class == "cell":
+        cells = np.empty(data.shape, dtype=object)
+        for i, ref in np.ndenumerate(data):
+            cells[i] = _read_h5_variable(h5file, h5file[ref])
+        return cells.T
+    return data.T
+
+def load_mat(path: str, variable_names=None) -> Mapping:
+    """
+    Load only the requested variables from a .mat file.
+    v5/v7 files are read with scipy.io.loadmat(variable_names=...);
+    v7.3 files are read with h5py and the file is closed before returning.
+    """
+    if not is_v73_mat(path):
+        return sio.loadmat(path, variable_names=variable_names)
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError(f"h5py is required to read MATLAB v7.3 files: {path}") from e
+    with h5py.File(path, "r") as f:
+        names = [k for k in f.keys() if not k.startswith("#")]
+        if variable_names is not None:
+            names = [k for k in names if k in set(variable_names)]
+        return {k: _read_h5_variable(f, f[k]) for k in names}
+
+def load_preprocessed_mat(folder: str, nth: str, variable_names=None) -> Mapping:
     pattern = os.path.join(folder, f"pre-processed {nth}*.mat")
     candidates = glob.glob(pattern)
     if not candidates:
         raise FileNotFoundError(f"No matching MAT file for pattern: {pattern}")
     path = sorted(candidates)[0]
-    return sio.loadmat(path)
+    return load_mat(path, variable_names=variable_names)
 
 def get_value_by_label(df: pd.DataFrame, label: str):
     """
@@ -33,3 +88,92 @@ def get_value_by_label(df: pd.DataFrame, label: str):
         if label_norm in cell_norm:
             return df.iloc[idx, 1]
     raise KeyError(f"Label not found in first column: {label}")
+
+def _normalize_label(label) -> str:
+    return re.sub(r"[\s_]+", "", str(label)).lower()
+
+@dataclass(frozen=True)
+class ProjectDetails:
+    """
+    Parsed header of the "Project Details" sheet.
+    `labels` maps normalized first-column labels to the adjacent cell value;
+    the reference arrays hold the "<filename>.tif,<index>" lines that follow
+    "Number of References".
+    """
+    path: str
+    labels: dict
+    n_references: int
+    reference_filenames: np.ndarray = field(repr=False)
+    reference_indices: np.ndarray = field(repr=False)
+
+    def get(self, label: str):
+        """
+        Same matching rule as get_value_by_label: return the value of the first
+        row (in sheet order) whose normalized label contains the given label.
+        """
+        label_norm = _normalize_label(label)
+        for key, value in self.labels.items():
+            if label_norm in key:
+                return value
+        raise KeyError(f"Label not found in first column: {label}")
+
+    @property
+    def x_step(self) -> float:
+        return float(self.get("x_step"))
+
+    @property
+    def y_step(self) -> float:
+        return float(self.get("y_step"))
+
+    def references_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "Filename": self.reference_filenames,
+            "Index": self.reference_indices,
+        })
+
+@lru_cache(maxsize=32)
+def _read_project_details_cached(path: str, mtime_ns: int, sheet_name: str) -> ProjectDetails:
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name]
+        labels = {}
+        n_ref = None
+        ref_remaining = 0
+        filenames, indices = [], []
+        for row in ws.iter_rows(min_col=1, max_col=2, values_only=True):
+            label, value = (tuple(row) + (None, None))[:2]
+            if ref_remaining > 0:
+                # "Number of References" の直後 n 行が参照パターン行
+                ref_remaining -= 1
+                m = _REFERENCE_LINE.match(str(value)) if value is not None else None
+                if m:
+                    filenames.append(m.group(1))
+                    indices.append(int(m.group(2)))
+            if label is None:
+                continue
+            key = _normalize_label(label)
+            labels.setdefault(key, value)
+            if n_ref is None and "numberofreferences" in key:
+                n_ref = int(value)
+                ref_remaining = n_ref
+    finally:
+        wb.close()
+    if n_ref is None:
+        raise KeyError("Label not found in first column: Number of References")
+    return ProjectDetails(
+        path=path,
+        labels=labels,
+        n_references=n_ref,
+        reference_filenames=np.array(filenames, dtype=object),
+        reference_indices=np.array(indices, dtype=int),
+    )
+
+def read_project_details(xlsx_path, sheet_name: str = "Project Details") -> ProjectDetails:
+    """
+    Stream the "Project Details" sheet once (openpyxl read-only mode) and
+    return a shared ProjectDetails. Results are cached per file and
+    modification time, so every consumer of the same workbook reuses one parse.
+    """
+    path = os.path.abspath(str(xlsx_path))
+    return _read_project_details_cached(path, os.stat(path).st_mtime_ns, sheet_name)
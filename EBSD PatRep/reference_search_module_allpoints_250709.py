@@ -3,12 +3,16 @@
 import numpy as np
 import pandas as pd
 import re
-from scipy.io import loadmat
 from scipy.spatial.transform import Rotation as R
 from tqdm import tqdm
 import tkinter as tk
 from tkinter import simpledialog
-from preprocessed_loader import load_preprocessed_xlsx, load_preprocessed_mat, get_value_by_label
+from pathlib import Path
+from pattern_similarity import build_tif_coord_map, closest_tif, verify_jobs
+from preprocessed_loader import load_preprocessed_xlsx, load_preprocessed_mat, load_mat, read_project_details
+
+# マッチングに必要な .mat 変数（それ以外は読み込まない）
+MATCHING_MAT_VARS = ["euler_phi1", "euler_phi", "euler_phi2", "image_quality", "phase_index"]
 
 # スケールファクターダイアログ用のグローバルキャッシュ
 cached_scale_factor = None
@@ -36,12 +40,10 @@ def misorientation_angle_deg(g1, g2, sym_ops):
             min_angle = angle_deg
     return min_angle
 
-# Excelファイルから参照ステップを読み取り、DataFrameで返す
+# Excelファイルから参照ステップ (x_step, y_step) を読み取る
 def read_steps_from_excel(excel_path):
-    df = pd.read_excel(excel_path, sheet_name="Project Details", header=None)
-    x_step = float(get_value_by_label(df, "x_step"))
-    y_step = float(get_value_by_label(df, "y_step"))
-    return x_step, y_step
+    details = read_project_details(excel_path)
+    return details.x_step, details.y_step
 
 # matファイル内の全点のオイラー角、IQ、位相をフラット化してDataFrameにまとめる
 def flatten_all_points(mat):
@@ -71,19 +73,14 @@ def flatten_all_points(mat):
 
 # 指定されたExcelおよびmatファイルからターゲット（変形）点情報を抽出する
 def extract_target_points(excel_path, mat_path):
-    df_excel = pd.read_excel(excel_path, sheet_name="Project Details", header=None)
-    n_targets = int(get_value_by_label(df_excel, "Number of References"))
-    idx0 = df_excel[df_excel.iloc[:,0].astype(str).str.contains("Number of References")].index[0]
-    target_lines = df_excel.iloc[idx0+1:idx0+1+n_targets, 1].dropna()
-    extracted = target_lines.str.extract(r'(^.+\.tif),(\d+)$')
-    extracted.columns = ["Deformed_Filename", "Deformed_Index"]
-    extracted["Deformed_Index"] = extracted["Deformed_Index"].astype(int)
-    mat = loadmat(mat_path)
+    details = read_project_details(excel_path)
+    extracted = details.references_frame().rename(
+        columns={"Filename": "Deformed_Filename", "Index": "Deformed_Index"})
+    mat = load_mat(mat_path, variable_names=MATCHING_MAT_VARS)
     phi1 = mat["euler_phi1"]
     Phi  = mat["euler_phi"]
     phi2 = mat["euler_phi2"]
-    phase = mat.get('phase_index', None)  # フェーズマップ
-    phase = mat.get("phase_index", None)
+    phase = mat.get("phase_index", None)  # フェーズマップ
     nrows, ncols = phi1.shape
     data = []
     for _, row in extracted.iterrows():
@@ -111,10 +108,24 @@ def run_misorientation_matching_all_vs_targets(
     angle_threshold=5.0,
     iq_percentile=0.0,
     sym_ops=None,
-    target_phase=None):
+    target_phase=None,
+    verify_patterns=False,
+    deformed_tif_dirs=None,
+    verify_top_k=5,
+    ncc_threshold=None,
+    verify_workers=None,
+    coord_map=None):
+    """
+    verify_patterns=True の場合、IQ 上位 verify_top_k 個の候補 tif を変形パターン
+    （deformed_tif_dirs の先頭から探索）と FFT 正規化相互相関で比較し、NCC 最大の候補を採用する。
+    ncc_threshold 未満なら置換対象から除外する。変形パターンや候補 tif が見つからず検証できない
+    ターゲットはログに出し、ncc_threshold 指定時はしきい値を満たさないものとして除外する
+    （未指定なら IQ 最大の候補を Pattern_NCC=NaN で採用）。
+    coord_map: build_tif_coord_map(tif_dir) の結果。渡せば tif_dir を毎回走査しない。
+    """
     global cached_scale_factor
     print(f"Selected symmetry operations count: {len(sym_ops)}")
-    mat_0th = loadmat(mat_0th_path)
+    mat_0th = load_mat(mat_0th_path, variable_names=MATCHING_MAT_VARS)
     all_points_df, ncols = flatten_all_points(mat_0th)
     target_df = extract_target_points(excel_nth_path, mat_nth_path)
     # Filter reference points by phase
@@ -134,8 +145,14 @@ def run_misorientation_matching_all_vs_targets(
         root.destroy()
     scale_factor = cached_scale_factor
 
+    def tif_coords(a_row):
+        col = int(round(a_row["col"] * x_step * scale_factor))
+        row = int(round(a_row["row"] * y_step * scale_factor))
+        return col, row
+
     IQ_threshold = np.percentile(all_points_df["IQ"], iq_percentile)
-    results = []
+    # (ターゲット行, IQ 降順の候補リスト)
+    matches = []
     for _, t_row in tqdm(target_df.iterrows(), total=len(target_df), desc="Computing misorientation"):
         # 指定されている場合、現在のフェーズにないターゲットポイントをスキップ
         if target_phase is not None and t_row.get("phase") != target_phase:
@@ -156,20 +173,65 @@ def run_misorientation_matching_all_vs_targets(
                 candidates.append(row_copy)
         if not candidates:
             continue
-        best_row = max(candidates, key=lambda x: x["IQ"])
+        # 安定ソートなので同IQでは従来の max() と同じ候補が先頭になる
+        candidates.sort(key=lambda x: x["IQ"], reverse=True)
+        matches.append((t_row, candidates))
+
+    # ── パターン類似度による検証・並べ替え ─────────
+    ncc_scores = [None] * len(matches)
+    # 検証に使う候補（tif が見つかったもの）を matches と同じ順で保持
+    verified_candidates = [None] * len(matches)
+    if verify_patterns and matches:
+        if coord_map is None:
+            coord_map = build_tif_coord_map(tif_dir)
+        dirs = [Path(d) for d in (deformed_tif_dirs or [])]
+        jobs, job_pos = [], []
+        for i, (t_row, candidates) in enumerate(matches):
+            deformed_path = next((d / t_row["Deformed_Filename"] for d in dirs
+                                  if (d / t_row["Deformed_Filename"]).exists()), None)
+            top = [(c, closest_tif(*tif_coords(c), coord_map)) for c in candidates[:verify_top_k]]
+            top = [(c, p) for c, p in top if p is not None]
+            if deformed_path is None or not top:
+                continue
+            verified_candidates[i] = [c for c, _ in top]
+            jobs.append((str(deformed_path), [str(p) for _, p in top]))
+            job_pos.append(i)
+        for i, scores in zip(job_pos, verify_jobs(jobs, max_workers=verify_workers)):
+            ncc_scores[i] = scores
+
+    results = []
+    unverified = []
+    for (t_row, candidates), scores, checked in zip(matches, ncc_scores, verified_candidates):
+        best_row = candidates[0]
+        best_ncc = None
+        if scores is not None:
+            best = int(np.argmax(scores))
+            best_row, best_ncc = checked[best], float(scores[best])
+            if ncc_threshold is not None and best_ncc < ncc_threshold:
+                continue
+        elif verify_patterns:
+            unverified.append(t_row["Deformed_Filename"])
+            # スコアが無いものはしきい値を満たしたとは言えないので除外する
+            if ncc_threshold is not None:
+                continue
         min_angle = best_row["angle"]
         if min_angle <= angle_threshold:
-            col = int(round(best_row["col"] * x_step * scale_factor))
-            row = int(round(best_row["row"] * y_step * scale_factor))
+            col, row = tif_coords(best_row)
             matched_filename = f"0th_x{col}y{row}.tif"
-            results.append({
+            result = {
                 "Deformed_Filename": t_row["Deformed_Filename"],
                 "Matched_0th_Filename": matched_filename,
                 "Deformed_Index": t_row["Deformed_Index"],
                 "Matched_0th_Index": best_row["Index"],
                 "Matched_0th_IQ": best_row["IQ"],
                 "Misorientation (deg)": round(min_angle, 1)
-            })
+            }
+            if verify_patterns:
+                result["Pattern_NCC"] = round(best_ncc, 3) if best_ncc is not None else np.nan
+            results.append(result)
+    if unverified:
+        action = "除外しました" if ncc_threshold is not None else "IQ 最大の候補を採用しました (Pattern_NCC=NaN)"
+        print(f"⚠ パターン検証できなかったターゲット {len(unverified)} 件を{action}: {' '.join(unverified)}")
     df = pd.DataFrame(results)
     def natural_sort_key(s):
         return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
@@ -0,0 +1,81 @@
+
+# マッチング結果の列指向ストア（Parquet データセット、nth / phase でパーティション分割）
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+RESULTS_DIR = "results"
+RUNS_FILE = "runs.parquet"
+
+def _partition_dir(store_dir, nth_name):
+    return Path(store_dir) / RESULTS_DIR / f"nth={nth_name}"
+
+def append_match_results(store_dir, nth_name, df, angle_threshold, phase_symmetry,
+                         number_of_references, unmatched):
+    """
+    1つの nth ステップのマッチング結果と実行メタデータをストアに書き込む。
+    同じ nth の既存パーティションは置き換える（再実行しても重複しない）。
+    各パーティション内は Deformed_Index でソートし、行グループ統計で絞り込めるようにする。
+    """
+    store_dir = Path(store_dir)
+    (store_dir / RESULTS_DIR).mkdir(parents=True, exist_ok=True)
+
+    part_dir = _partition_dir(store_dir, nth_name)
+    if part_dir.exists():
+        shutil.rmtree(part_dir)
+    if len(df):
+        out = df.sort_values("Deformed_Index").copy()
+        out["nth"] = nth_name
+        out["phase"] = out["phase"].astype(str)
+        out.to_parquet(store_dir / RESULTS_DIR, partition_cols=["nth", "phase"], index=False)
+
+    run = pd.DataFrame([{
+        "nth": nth_name,
+        "angle_threshold": float(angle_threshold),
+        "phase_symmetry": json.dumps(phase_symmetry, ensure_ascii=False),
+        "number_of_references": int(number_of_references),
+        "number_of_matched_patterns": int(len(df)),
+        "no_matched_patterns": " ".join(unmatched),
+        "written_at": datetime.now().isoformat(timespec="seconds"),
+    }])
+    runs_path = store_dir / RUNS_FILE
+    if runs_path.exists():
+        runs = pd.read_parquet(runs_path)
+        runs = pd.concat([runs[runs["nth"] != nth_name], run], ignore_index=True)
+    else:
+        runs = run
+    runs.to_parquet(runs_path, index=False)
+
+def read_match_results(store_dir, nth=None, phase=None, deformed_index=None, columns=None):
+    """
+    ストアからマッチング結果を読み込む。nth / phase / deformed_index（単一値またはリスト）で
+    絞り込むと、該当パーティションと行グループだけが読まれる。
+    ステップごとに列が異なる場合（例: --verify-patterns の有無で Pattern_NCC が増える）も、
+    全パーティションのスキーマを統合して読むので列は欠けない（無い値は NaN）。
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    root = str(Path(store_dir) / RESULTS_DIR)
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    schema = pa.unify_schemas([dataset.schema] + [f.physical_schema for f in dataset.get_fragments()])
+    dataset = ds.dataset(root, schema=schema, format="parquet", partitioning="hive")
+
+    expr = None
+    for col, value in (("nth", nth), ("phase", phase), ("Deformed_Index", deformed_index)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            cond = ds.field(col).isin(list(value))
+        else:
+            cond = ds.field(col) == value
+        expr = cond if expr is None else expr & cond
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+def read_runs(store_dir):
+    """nth ステップごとの実行メタデータ（しきい値・Phase ごとの対称性・参照点数・非マッチ一覧）"""
+    runs = pd.read_parquet(Path(store_dir) / RUNS_FILE)
+    runs["phase_symmetry"] = runs["phase_symmetry"].map(json.loads)
+    return runs
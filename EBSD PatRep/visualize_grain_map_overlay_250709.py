@@ -1,10 +1,11 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from preprocessed_loader import get_value_by_label
-from scipy.io import loadmat
+from matplotlib.figure import Figure
+from preprocessed_loader import load_mat, read_project_details
 
 def generate_green_blue_color():
     r = np.random.uniform(0.0, 0.3)
@@ -12,66 +13,109 @@ def generate_green_blue_color():
     b = np.random.uniform(0.4, 1.0)
     return np.array([r, g, b])
 
-def visualize_grain_map(mat_path, xlsx_path, csv_path, save_path=None):
-    if save_path is None:
-        mat_dir = os.path.dirname(mat_path)
-        nth_name = os.path.basename(mat_path).replace('pre-processed ', '').replace('.mat', '')
-        save_path = os.path.join(mat_dir, f"matching map {nth_name}.png")
+def default_save_path(mat_path):
+    mat_dir = os.path.dirname(mat_path)
+    nth_name = os.path.basename(mat_path).replace('pre-processed ', '').replace('.mat', '')
+    return os.path.join(mat_dir, f"matching map {nth_name}.png")
+
+def load_grain_map(mat_path):
+    return load_mat(mat_path, variable_names=["grain_number"])["grain_number"]
 
+def grain_rgb_map(grain_id):
+    """grain_number を粒ごとにランダムな緑〜青で塗った RGB 画像（NaN は白）"""
+    valid = ~np.isnan(grain_id)
+    unique_ids, inverse = np.unique(grain_id[valid], return_inverse=True)
+    colors = np.array([generate_green_blue_color() for _ in unique_ids]).reshape(-1, 3)
+    rgb_map = np.ones(grain_id.shape + (3,))
+    rgb_map[valid] = colors[inverse]
+    return rgb_map
+
+def draw_grain_map(ax, grain_id, references, matched_filenames):
     """
-    .matのgrain_numberを緑〜青で表示し、マッチ点を黒・非マッチ点を赤＋ファイル名付きで表示
+    grainマップを緑〜青で表示し、マッチ点を黒・非マッチ点を赤＋ファイル名付きで描く
+    references: Filename / Index 列を持つ DataFrame（ProjectDetails.references_frame()）
     """
-    # grainマップの準備
-    mat = loadmat(mat_path)
-    grain_id = mat["grain_number"]
-    nrows, ncols = grain_id.shape
-    unique_ids = np.unique(grain_id[~np.isnan(grain_id)])
-    cmap_dict = {gid: generate_green_blue_color() for gid in unique_ids}
-    rgb_map = np.ones((nrows, ncols, 3))
-    for r in range(nrows):
-        for c in range(ncols):
-            gid = grain_id[r, c]
-            if not np.isnan(gid):
-                rgb_map[r, c] = cmap_dict[gid]
+    ncols = grain_id.shape[1]
+    ax.imshow(grain_rgb_map(grain_id), origin='upper')
+
+    # ファイル名ごとにmatched/unmatched分類
+    is_matched = references["Filename"].isin(matched_filenames)
+    # matched → 黒 + ラベル、unmatched → 赤 + ラベル
+    for subset, style, color in ((references[is_matched], 'ks', 'black'),
+                                 (references[~is_matched], 'rs', 'red')):
+        r, c = np.divmod(subset["Index"].to_numpy(), ncols)
+        ax.plot(c, r, style, markersize=4)
+        for ci, ri, name in zip(c, r, subset["Filename"]):
+            ax.text(ci + 1, ri, name, fontsize=6, color=color)
 
-    # xlsxから参照ファイル名とIndexを取得
-    df_excel = pd.read_excel(xlsx_path, sheet_name="Project Details", header=None)
-    n_ref = int(get_value_by_label(df_excel, "Number of References"))
-    idx = df_excel[df_excel.iloc[:,0].astype(str).str.contains("Number of References")].index[0]
-    idx = df_excel[df_excel.iloc[:,0].astype(str).str.contains("Number of References")].index[0]
-    target_lines = df_excel.iloc[idx+1:idx+1+n_ref, 1].dropna().dropna().dropna()
-    extracted = target_lines.str.extract(r'(^.+\.tif),(\d+)$')
-    extracted.columns = ["Filename", "Index"]
-    extracted["Index"] = extracted["Index"].astype(int)
+    ax.set_title("Grain map (green-blue) + Match overlay with labels")
+    ax.set_xlabel("X (col)")
+    ax.set_ylabel("Y (row)")
+
+def visualize_grain_map(mat_path, xlsx_path, csv_path, save_path=None, show=True):
+    """
+    .matのgrain_numberを緑〜青で表示し、マッチ点を黒・非マッチ点を赤＋ファイル名付きで表示
+    """
+    if save_path is None:
+        save_path = default_save_path(mat_path)
 
-    # CSVからマッチ済みファイル名を取得
+    # grainマップ、xlsxの参照ファイル名とIndex、CSVのマッチ済みファイル名
+    grain_id = load_grain_map(mat_path)
+    references = read_project_details(xlsx_path).references_frame()
     df_csv = pd.read_csv(csv_path, comment="#")
     matched_filenames = set(df_csv["Deformed_Filename"].values)
 
-    # ファイル名ごとにmatched/unmatched分類
-    matched_df = extracted[extracted["Filename"].isin(matched_filenames)]
-    unmatched_df = extracted[~extracted["Filename"].isin(matched_filenames)]
-
     # プロット
-    fig, ax = plt.subplots(figsize=(10, 10))
-    ax.imshow(rgb_map, origin='upper')
+    if show:
+        fig, ax = plt.subplots(figsize=(10, 10))
+    else:
+        # 表示しない場合は pyplot を介さず Figure を直接作る（バックグラウンドスレッドからも描画可）
+        fig = Figure(figsize=(10, 10))
+        ax = fig.subplots()
+    draw_grain_map(ax, grain_id, references, matched_filenames)
+    if save_path:
+        fig.savefig(save_path, dpi=300, bbox_inches='tight')
+    if show:
+        plt.show()
 
-    # matched → 黒 + ラベル、unmatched → 赤 + ラベル
-    for _, row in matched_df.iterrows():
-        idx = row["Index"]
-        r, c = divmod(idx, ncols)
-        ax.plot(c, r, 'ks', markersize=4)
-        ax.text(c + 1, r, row["Filename"], fontsize=6, color='black')
+def render_grain_map_task(task, show=False):
+    """
+    読み込み済みデータ（grain_id, references, matched_filenames）からマップを保存する。
+    show=False では pyplot を使わずに描画する。preview_dpi を指定すると低解像度のプレビューも保存する。
+    """
+    if show:
+        fig, ax = plt.subplots(figsize=(10, 10))
+    else:
+        fig = Figure(figsize=(10, 10))
+        ax = fig.subplots()
+    draw_grain_map(ax, task["grain_id"], task["references"], task["matched_filenames"])
+    fig.savefig(task["save_path"], dpi=300, bbox_inches='tight')
+    if task.get("preview_dpi"):
+        root, ext = os.path.splitext(task["save_path"])
+        fig.savefig(f"{root}_preview{ext}", dpi=task["preview_dpi"], bbox_inches='tight')
+    if show:
+        plt.show()
+    return task["save_path"]
 
-    for _, row in unmatched_df.iterrows():
-        idx = row["Index"]
-        r, c = divmod(idx, ncols)
-        ax.plot(c, r, 'rs', markersize=4)
-        ax.text(c + 1, r, row["Filename"], fontsize=6, color='red')
+def _init_headless_worker():
+    import matplotlib
+    matplotlib.use("Agg")
 
-    ax.set_title("Grain map (green-blue) + Match overlay with labels")
-    ax.set_xlabel("X (col)")
-    ax.set_ylabel("Y (row)")
-    if save_path:
-        plt.savefig(save_path, dpi=300, bbox_inches='tight')
-    plt.show()
+def headless_render_pool(max_workers=None):
+    """render_grain_map_task を投げるためのプロセスプール（各ワーカーは Agg バックエンド）"""
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_headless_worker)
+
+def render_grain_maps_parallel(tasks, max_workers=None):
+    """
+    複数ステップのマップをプロセスプール（Agg バックエンド）で並列に保存する。
+    戻り値は tasks と同じ順の (save_path, エラー or None)。
+    """
+    results = []
+    with headless_render_pool(max_workers) as ex:
+        futures = [ex.submit(render_grain_map_task, task) for task in tasks]
+        for task, fut in zip(tasks, futures):
+            try:
+                results.append((fut.result(), None))
+            except Exception as e:
+                results.append((task["save_path"], e))
+    return results
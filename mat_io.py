@@ -0,0 +1,57 @@
+
+# .mat の読み込み共通処理（v5/v7 は scipy.io、v7.3 は h5py）。mat_to_excel_batch_exporter と stress_strain_mapper で共用
+import numpy as np
+import scipy.io
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+def is_v73_mat(mat_path):
+    # v7.3 の .mat は 512 バイトのヘッダに続く HDF5 ファイル
+    with open(mat_path, "rb") as f:
+        head = f.read(520)
+    return head[:8] == HDF5_SIGNATURE or head[512:520] == HDF5_SIGNATURE
+
+def _matlab_class(obj):
+    matlab_class = obj.attrs.get("MATLAB_class", obj.dtype.name)
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode()
+    return matlab_class
+
+def _read_h5_variable(h5file, obj):
+    """v7.3 の変数を1つ読み、転置して loadmat と同じ (row, col) の形で返す（char / cell も復元）"""
+    matlab_class = _matlab_class(obj)
+    data = obj[()]
+    if matlab_class == "char":
+        # uint16 の文字コード列 → loadmat と同様に str の配列で返す
+        return np.array(["".join(chr(c) for c in np.ravel(data.T, order="F"))])
+    if matlab_class == "cell":
+        cells = np.empty(data.shape, dtype=object)
+        for i, ref in np.ndenumerate(data):
+            cells[i] = _read_h5_variable(h5file, h5file[ref])
+        return cells.T
+    return data.T
+
+def _h5_variables(h5file):
+    """v7.3 のトップレベル変数（HDF5 の Dataset）の名前。"#refs#" などの内部データと構造体（Group）は除く"""
+    import h5py
+    return [k for k, obj in h5file.items() if not k.startswith("#") and isinstance(obj, h5py.Dataset)]
+
+def load_mat_variables(mat_path, variable_names=None):
+    """指定した変数だけを {変数名: 配列} で読み込む（variable_names=None なら全変数）"""
+    if is_v73_mat(mat_path):
+        import h5py
+        with h5py.File(mat_path, "r") as f:
+            names = _h5_variables(f)
+            if variable_names is not None:
+                names = [k for k in names if k in set(variable_names)]
+            return {k: _read_h5_variable(f, f[k]) for k in names}
+    data = scipy.io.loadmat(mat_path, variable_names=None if variable_names is None else list(variable_names))
+    return {k: v for k, v in data.items() if not k.startswith("__")}
+
+def scan_mat_schema(mat_path):
+    """データを読まずにヘッダだけから {変数名: (shape, dtype)} を返す"""
+    if is_v73_mat(mat_path):
+        import h5py
+        with h5py.File(mat_path, "r") as f:
+            return {k: (tuple(reversed(f[k].shape)), _matlab_class(f[k])) for k in _h5_variables(f)}
+    return {name: (tuple(shape), dtype) for name, shape, dtype in scipy.io.whosmat(mat_path)}
@@ -1,27 +1,69 @@
-import scipy.io
+import numpy as np
 import pandas as pd
 import tkinter as tk
 from tkinter import filedialog, messagebox, MULTIPLE
 import os
+from mat_io import load_mat_variables, scan_mat_schema
 
-def load_mat_variables(mat_path):
-    data = scipy.io.loadmat(mat_path)
-    return {k: v for k, v in data.items() if not k.startswith("__")}
+def scan_folder_schema(folder_path):
+    """フォルダ内の全 .mat のスキーマを {ファイル名: スキーマ} で返す（読めないファイルは除外して表示）"""
+    schemas = {}
+    for f in sorted(os.listdir(folder_path)):
+        if not f.lower().endswith(".mat"):
+            continue
+        try:
+            schemas[f] = scan_mat_schema(os.path.join(folder_path, f))
+        except Exception as e:
+            print(f"{f} のヘッダ読み込み中にエラー: {e}")
+    return schemas
+
+def summarize_schemas(schemas):
+    """
+    全ファイルの変数の和集合を [(変数名, shape, dtype, 含むファイル数)] で返す。
+    shape / dtype はファイルごとに異なる場合があるので最初に見つかったものを代表とする。
+    """
+    summary = {}
+    for schema in schemas.values():
+        for name, (shape, dtype) in schema.items():
+            if name not in summary:
+                summary[name] = [shape, dtype, 0]
+            summary[name][2] += 1
+    return [(name, shape, dtype, count) for name, (shape, dtype, count) in summary.items()]
+
+def find_files_to_skip(schemas, selected_vars):
+    """選択変数で出力するとスキップされるファイルを {ファイル名: 理由} で返す（データは読まない）"""
+    skipped = {}
+    for mat_file, schema in schemas.items():
+        present = [v for v in selected_vars if v in schema]
+        if not present:
+            skipped[mat_file] = "エクスポート可能な変数がありません"
+            continue
+        lengths = {int(np.prod(schema[v][0])) for v in present}
+        if len(lengths) != 1:
+            skipped[mat_file] = "変数の長さが一致しません"
+    return skipped
 
-def export_selected_variables_batch(folder_path, selected_vars, save_folder):
+def export_selected_variables_batch(folder_path, selected_vars, save_folder, schemas=None):
     mat_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".mat")]
     if not mat_files:
         messagebox.showerror("エラー", "指定フォルダに.matファイルが存在しません。")
         return
 
+    var_list = [v.split(" (")[0] for v in selected_vars]  # 元の変数名を抽出
+    # ヘッダだけでスキップ対象を判定し、無駄なロードを避ける
+    skipped = find_files_to_skip(schemas, var_list) if schemas is not None else {}
+    for mat_file, reason in skipped.items():
+        print(f"{mat_file}: {reason}。スキップされます。")
+
     for mat_file in mat_files:
+        if mat_file in skipped:
+            continue
         mat_path = os.path.join(folder_path, mat_file)
-        variables = load_mat_variables(mat_path)
+        variables = load_mat_variables(mat_path, variable_names=var_list)
         combined_data = {}
         lengths = []
 
-        for var_display in selected_vars:
-            var = var_display.split(" (")[0]  # 元の変数名を抽出
+        for var in var_list:
             if var in variables:
                 array = variables[var]
                 try:
@@ -52,20 +94,20 @@ def batch_process():
     if not folder_path:
         return
 
-    example_mat = None
-    for f in os.listdir(folder_path):
-        if f.lower().endswith(".mat"):
-            example_mat = os.path.join(folder_path, f)
-            break
-    if not example_mat:
+    schemas = scan_folder_schema(folder_path)
+    if not schemas:
         messagebox.showerror("エラー", "フォルダ内に.matファイルが見つかりません。")
         return
 
-    variables = load_mat_variables(example_mat)
-    var_names = [f"{k} {v.shape}" for k, v in variables.items()]
+    n_files = len(schemas)
+    summary = summarize_schemas(schemas)
+    var_names = [f"{name} {shape} {dtype} [{count}/{n_files}]" for name, shape, dtype, count in summary]
+    n_common = sum(1 for *_, count in summary if count == n_files)
 
     select_win = tk.Toplevel(root)
     select_win.title("エクスポートする変数を選択")
+    tk.Label(select_win, text=f"{n_files} ファイル / 変数: 全体 {len(summary)}, 全ファイル共通 {n_common}"
+             ).pack(padx=10, pady=(10, 0))
     listbox = tk.Listbox(select_win, selectmode=MULTIPLE, width=60, height=20)
     listbox.pack(padx=10, pady=10)
     for name in var_names:
@@ -77,10 +119,15 @@ def batch_process():
         if not selected_vars:
             messagebox.showwarning("警告", "少なくとも1つの変数を選択してください。")
             return
+        skipped = find_files_to_skip(schemas, [v.split(" (")[0] for v in selected_vars])
+        if skipped:
+            detail = "\n".join(f"{f}: {reason}" for f, reason in list(skipped.items())[:20])
+            if not messagebox.askyesno("確認", f"{len(skipped)} 個のファイルがスキップされます。\n{detail}\n\n続行しますか？"):
+                return
         save_folder = filedialog.askdirectory(title="エクスポート先フォルダを選択")
         if not save_folder:
             return
-        export_selected_variables_batch(folder_path, selected_vars, save_folder)
+        export_selected_variables_batch(folder_path, selected_vars, save_folder, schemas=schemas)
         select_win.destroy()
 
     export_btn = tk.Button(select_win, text="バッチエクスポート", command=on_export)
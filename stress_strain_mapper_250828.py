@@ -7,20 +7,33 @@ Interactive Stress–Strain Mapper
 - **Curve Mode** を追加：
     - point     : クリック/ホバーした点の曲線
     - grain-avg : その点が属する Grain の「平均」曲線
+    - region-rect / region-lasso : 矩形・投げ縄で囲んだ領域の平均 ± std 曲線
 - 境界線は **黒** 固定（LineCollection color='k'）
 - 別ウィンドウ（Matplotlib）で Click/Hover と Boundaries ON/OFF、Curve Mode を切替
+- Excel の代わりに .mat（ファイルまたはステップごとの .mat のフォルダ）を直接読み込み可能（--mat-map で変数名を指定）
+- Controls の Step スライダーで、マップを選択ステップの stress / strain / 前ステップからの変化量で色分け
+- 応力・ひずみは float32 で1本だけ保持（--cache でバイナリキャッシュを memmap 読み込み）
+- --batch : GUI なしで Grain 平均/std 曲線・指定点の曲線を CSV/Parquet に、Grain ごとの曲線を画像に書き出し
 """
 
 import argparse
+import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from matplotlib.widgets import RadioButtons, CheckButtons
+from matplotlib.widgets import RadioButtons, CheckButtons, RectangleSelector, LassoSelector, Slider
+from matplotlib.path import Path as MplPath
 from matplotlib.collections import LineCollection
 from matplotlib import colors as mcolors
 
+from mat_io import load_mat_variables
+
 
 # 追加：ウィンドウ位置をずらすヘルパー（バックエンドごとに試行）
 def set_window_position(fig, x, y):
@@ -43,7 +56,7 @@ def set_window_position(fig, x, y):
 
 
 def choose_excel_via_dialog(initial: Path | None = None) -> Path | None:
-    """TkファイルダイアログでExcelを選択（失敗時は None を返す）"""
+    """TkファイルダイアログでExcel / MATを選択（失敗時は None を返す）"""
     try:
         import tkinter as tk
         from tkinter import filedialog
@@ -53,11 +66,12 @@ def choose_excel_via_dialog(initial: Path | None = None) -> Path | None:
         root.update()  # 安定化
         filetypes = [
             ("Excel files", "*.xlsx *.xls"),
+            ("MAT files", "*.mat"),
             ("All files", "*.*"),
         ]
         initialdir = str(initial) if initial and initial.is_dir() else str(Path.cwd())
         path = filedialog.askopenfilename(
-            title="Select Excel file",
+            title="Select Excel or MAT file",
             initialdir=initialdir,
             filetypes=filetypes,
         )
@@ -85,6 +99,351 @@ def load_data(xlsx_path: Path):
     return geo, strain, stress
 
 
+@dataclass
+class MapperData:
+    """
+    マッパーが保持するデータ（DataFrame は保持しない）。
+    - x, y, subset_id, grain_id : 各点のジオメトリ（整数値なら int32）
+    - strain, stress            : (N_points, N_steps) の float32 配列または memmap
+    - steps                     : ステップ名（strain/stress の列名）
+    """
+    x: np.ndarray
+    y: np.ndarray
+    subset_id: np.ndarray
+    grain_id: np.ndarray
+    strain: np.ndarray
+    stress: np.ndarray
+    steps: list
+
+
+GEOMETRY_FIELDS = ("x", "y", "subset_id", "grain_id")
+CACHE_SUFFIX = ".mapper_cache"
+
+
+def compact_column(values):
+    """整数値だけの列は int32、それ以外は float32 にする"""
+    arr = np.asarray(values, dtype=float)
+    if np.all(np.isfinite(arr)) and np.all(arr == np.round(arr)):
+        return arr.astype(np.int32)
+    return arr.astype(np.float32)
+
+
+def to_mapper_data(geo, strain, stress, dtype=np.float32) -> MapperData:
+    return MapperData(
+        x=compact_column(geo["X_pixel_"].to_numpy()),
+        y=compact_column(geo["Y_pixel_"].to_numpy()),
+        subset_id=compact_column(geo["Subset_ID"].to_numpy()),
+        grain_id=compact_column(geo["Grain_ID"].to_numpy()),
+        strain=strain.to_numpy(dtype=dtype),  # shape: (N_points, N_steps)
+        stress=stress.to_numpy(dtype=dtype),
+        steps=[str(c) for c in strain.columns],
+    )
+
+
+# .mat の変数名の対応（--mat-map の JSON で上書き可能）
+DEFAULT_MAT_MAPPING = {
+    "x": "X_pixel_",
+    "y": "Y_pixel_",
+    "subset_id": "Subset_ID",
+    "grain_id": "Grain_ID",
+    "strain": "strain",
+    "stress": "stress",
+}
+
+
+def natural_sort_key(s):
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+
+
+def _require(variables, name, mat_path):
+    if name not in variables:
+        raise KeyError(f"{mat_path.name} に変数 '{name}' がありません（--mat-map で変数名を指定できます）")
+    return variables[name]
+
+
+def as_step_matrix(values, n_points, name):
+    """(N_points, N_steps)、(N_steps, N_points)、(rows, cols, N_steps) のいずれかを (N_points, N_steps) にする"""
+    arr = np.asarray(values, dtype=np.float32)
+    if arr.ndim == 2 and arr.shape[0] != n_points and arr.shape[1] == n_points:
+        return np.ascontiguousarray(arr.T)
+    if arr.size % n_points != 0:
+        raise ValueError(f"{name} の要素数 {arr.size} が点数 {n_points} の倍数ではありません。")
+    return arr.reshape(n_points, -1)
+
+
+def single_step_column(values, n_points, name, mat_path):
+    """ステップごとの .mat の値を1列にする（複数列なら黙って捨てずにエラー）"""
+    arr = as_step_matrix(values, n_points, name)
+    if arr.shape[1] != 1:
+        raise ValueError(f"{mat_path.name} の {name} は {arr.shape[1]} 列あります。"
+                         "フォルダ入力では1ファイル1ステップ（1列）である必要があります。")
+    return arr[:, 0]
+
+
+def load_mat_data(source: Path, mapping=None) -> MapperData:
+    """
+    .mat から直接 MapperData を作る（Excel を経由しない）。
+    - source が .mat ファイル : strain / stress は (N_points, N_steps) などのステップ行列
+    - source がフォルダ       : 中の .mat を自然順に1ステップずつ読み、各ファイルの strain / stress を1列とする
+                                （複数列のファイルや --mat-map の steps はエラー。ステップ名はファイル名）
+    ジオメトリ（x, y, subset_id, grain_id）は（先頭の）ファイルから flatten して読む。
+    """
+    mapping = {**DEFAULT_MAT_MAPPING, **(mapping or {})}
+    geo_names = [mapping[k] for k in GEOMETRY_FIELDS]
+    if source.is_dir():
+        mat_files = sorted(source.glob("*.mat"), key=lambda f: natural_sort_key(f.name))
+        if not mat_files:
+            raise FileNotFoundError(f"フォルダ内に .mat ファイルがありません: {source}")
+    else:
+        mat_files = [source]
+
+    first = load_mat_variables(mat_files[0], geo_names + [mapping["strain"], mapping["stress"]])
+    geometry = {k: compact_column(np.asarray(_require(first, mapping[k], mat_files[0])).flatten())
+                for k in GEOMETRY_FIELDS}
+    n_points = len(geometry["x"])
+    for k, v in geometry.items():
+        if len(v) != n_points:
+            raise ValueError(f"ジオメトリの長さが一致しません: x={n_points}, {k}={len(v)}")
+
+    if not source.is_dir():
+        strain = as_step_matrix(_require(first, mapping["strain"], mat_files[0]), n_points, "strain")
+        stress = as_step_matrix(_require(first, mapping["stress"], mat_files[0]), n_points, "stress")
+        steps = [str(s) for s in mapping.get("steps", range(strain.shape[1]))]
+    else:
+        if "steps" in mapping:
+            raise ValueError("フォルダ入力ではステップ名はファイル名から決まるため、--mat-map の 'steps' は指定できません。")
+        strain = np.empty((n_points, len(mat_files)), dtype=np.float32)
+        stress = np.empty((n_points, len(mat_files)), dtype=np.float32)
+        for j, mat_path in enumerate(mat_files):
+            variables = first if j == 0 else load_mat_variables(mat_path, [mapping["strain"], mapping["stress"]])
+            strain[:, j] = single_step_column(_require(variables, mapping["strain"], mat_path), n_points, "strain", mat_path)
+            stress[:, j] = single_step_column(_require(variables, mapping["stress"], mat_path), n_points, "stress", mat_path)
+        steps = [f.stem for f in mat_files]
+
+    if strain.shape != stress.shape:
+        raise ValueError(f"strain/stress の形が一致しません: strain={strain.shape}, stress={stress.shape}")
+    if len(steps) != strain.shape[1]:
+        raise ValueError(f"ステップ名の数 {len(steps)} が列数 {strain.shape[1]} と一致しません。")
+    return MapperData(strain=strain, stress=stress, steps=steps, **geometry)
+
+
+def source_mtime_ns(source_path: Path) -> int:
+    """キャッシュ判定用の更新時刻（フォルダなら中の .mat の最新時刻）"""
+    if source_path.is_dir():
+        return max((f.stat().st_mtime_ns for f in source_path.glob("*.mat")), default=0)
+    return source_path.stat().st_mtime_ns
+
+
+def save_binary_cache(data: MapperData, cache_dir: Path, source_path: Path | None = None,
+                      source_info: dict | None = None):
+    """
+    MapperData を .npy（memmap 可能）と meta.json のフォルダに書き出す。
+    source_path を渡すと、その更新時刻で古いキャッシュを判定できる。
+    source_info（読み込み元の種類と .mat 変数名の対応）も meta.json に残し、判定に使う。
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for name in GEOMETRY_FIELDS + ("strain", "stress"):
+        np.save(cache_dir / f"{name}.npy", np.ascontiguousarray(getattr(data, name)))
+    meta = {"steps": data.steps}
+    if source_path is not None:
+        meta["source"] = str(source_path.name)
+        meta["source_mtime_ns"] = source_mtime_ns(source_path)
+    if source_info is not None:
+        meta["source_info"] = source_info
+    (cache_dir / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+
+def load_binary_cache(cache_dir: Path, mmap=True) -> MapperData:
+    """save_binary_cache の出力を読み込む（strain/stress は memmap で開く）"""
+    meta = json.loads((cache_dir / "meta.json").read_text(encoding="utf-8"))
+    mode = "r" if mmap else None
+    arrays = {name: np.load(cache_dir / f"{name}.npy") for name in GEOMETRY_FIELDS}
+    arrays["strain"] = np.load(cache_dir / "strain.npy", mmap_mode=mode)
+    arrays["stress"] = np.load(cache_dir / "stress.npy", mmap_mode=mode)
+    return MapperData(steps=meta["steps"], **arrays)
+
+
+def binary_cache_is_fresh(cache_dir: Path, source_path: Path, source_info: dict | None = None) -> bool:
+    """元ファイルの更新時刻と source_info（種類・変数名の対応）が両方一致すれば有効"""
+    meta_path = cache_dir / "meta.json"
+    if not meta_path.exists():
+        return False
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    return (meta.get("source_mtime_ns") == source_mtime_ns(source_path)
+            and meta.get("source_info") == source_info)
+
+
+def load_mapper_data(source_path: Path, use_cache=False, mat_mapping=None) -> MapperData:
+    """
+    Excel / .mat / .mat のフォルダ / バイナリキャッシュ（*.mapper_cache）から MapperData を作る。
+    use_cache=True ならバイナリキャッシュ（Excel・.mat は隣、フォルダは中の <name>.mapper_cache）
+    を作り、以降は memmap で開く。
+    """
+    if source_path.is_dir() and source_path.suffix == CACHE_SUFFIX:
+        return load_binary_cache(source_path)
+    if source_path.is_dir():
+        cache_dir = source_path / f"{source_path.name}{CACHE_SUFFIX}"
+    else:
+        cache_dir = source_path.with_suffix(CACHE_SUFFIX)
+    if source_path.is_dir() or source_path.suffix.lower() == ".mat":
+        # 解決済みの変数名の対応（JSON で往復した形）をキャッシュ判定に含める
+        resolved = json.loads(json.dumps({**DEFAULT_MAT_MAPPING, **(mat_mapping or {})}, ensure_ascii=False))
+        source_info = {"kind": "mat-folder" if source_path.is_dir() else "mat", "mat_mapping": resolved}
+    else:
+        source_info = {"kind": "excel"}
+    if use_cache and binary_cache_is_fresh(cache_dir, source_path, source_info):
+        return load_binary_cache(cache_dir)
+    if source_info["kind"] == "excel":
+        data = to_mapper_data(*load_data(source_path))
+    else:
+        data = load_mat_data(source_path, mapping=mat_mapping)
+    if use_cache:
+        save_binary_cache(data, cache_dir, source_path=source_path, source_info=source_info)
+        return load_binary_cache(cache_dir)
+    return data
+
+
+def grain_codes(grain_id):
+    """
+    Grain_ID を連番コード化（非連続IDにも安定）。
+    codes[i] は 0..K-1、unique_grains[codes[i]] が元の Grain_ID
+    """
+    codes, unique_grains = pd.factorize(grain_id, sort=True)
+    return codes, np.asarray(unique_grains)
+
+
+def grain_color_mapping(K):
+    """マップと曲線で共通の turbo カラーマップと正規化"""
+    cmap = plt.get_cmap('turbo')
+    norm = mcolors.Normalize(vmin=0, vmax=max(1, K-1))
+    return cmap, norm
+
+
+def nan_group_stats(values, codes, K, chunk_rows=65536):
+    """
+    values (N_points, N_steps) を codes (0..K-1、負の値は無視) ごとに NaN を無視して集計し、
+    (mean, std, count) をそれぞれ (K, N_steps) で返す。std は np.nanstd と同じ母標準偏差。
+    行を chunk_rows ずつ読み、np.bincount で (K, N_steps) の和に足し込むので、
+    memmap でも全体のコピーは作らない（作業メモリは chunk_rows × N_steps 程度）。
+    """
+    n_points, n_steps = values.shape
+    codes = np.asarray(codes)
+    step_idx = np.arange(n_steps)
+    s1 = np.zeros(K * n_steps)
+    s2 = np.zeros(K * n_steps)
+    count = np.zeros(K * n_steps)
+    for r0 in range(0, n_points, chunk_rows):
+        c = codes[r0:r0 + chunk_rows]
+        block = np.asarray(values[r0:r0 + chunk_rows])
+        keep = c >= 0
+        if not keep.all():
+            c, block = c[keep], block[keep]
+        finite = np.isfinite(block)
+        v = np.where(finite, block, 0).astype(np.float64)
+        idx = (c[:, None] * n_steps + step_idx).ravel()
+        s1 += np.bincount(idx, weights=v.ravel(), minlength=K * n_steps)
+        s2 += np.bincount(idx, weights=(v * v).ravel(), minlength=K * n_steps)
+        count += np.bincount(idx[finite.ravel()], minlength=K * n_steps)
+    s1 = s1.reshape(K, n_steps)
+    s2 = s2.reshape(K, n_steps)
+    count = count.reshape(K, n_steps).astype(np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s1 / count
+        std = np.sqrt(np.maximum(s2 / count - mean ** 2, 0.0))
+    return mean, std, count
+
+
+def _step_blocks(values, diff=False, chunk_rows=65536):
+    """
+    values (N_points, N_steps) を行ブロックごとに float64 で返す（memmap でも先頭から順に1回読むだけ）。
+    diff=True なら前ステップからの変化量（0th は 0）に変換する。
+    """
+    n_points = values.shape[0]
+    for r0 in range(0, n_points, chunk_rows):
+        block = np.asarray(values[r0:r0 + chunk_rows], dtype=np.float64)
+        if diff:
+            d = np.empty_like(block)
+            d[:, 0] = 0.0
+            d[:, 1:] = np.diff(block, axis=1)
+            block = d
+        yield r0, block
+
+
+def chunked_step_percentiles(values, qs, diff=False, chunk_rows=65536, bins=4096, rounds=2):
+    """
+    各ステップ（列）のパーセンタイルを行ブロック単位の走査だけで求め、(len(qs), N_steps) で返す。
+    最小・最大を1回読んで求めたあと、ヒストグラムで目標順位の値を含むビンを rounds 回絞り込む
+    （誤差は値の範囲 / bins**rounds 程度）。有限値が無いステップは NaN。
+    """
+    n_steps = values.shape[1]
+    qs = np.asarray(qs, dtype=float)
+    lo = np.full(n_steps, np.inf)
+    hi = np.full(n_steps, -np.inf)
+    n = np.zeros(n_steps, dtype=np.int64)
+    for _, block in _step_blocks(values, diff, chunk_rows):
+        finite = np.isfinite(block)
+        n += finite.sum(axis=0)
+        lo = np.minimum(lo, np.where(finite, block, np.inf).min(axis=0))
+        hi = np.maximum(hi, np.where(finite, block, -np.inf).max(axis=0))
+    has = n > 0
+
+    # np.nanpercentile（線形補間）と同じく、0 始まりの順位 floor(r) と ceil(r) の値を探して補間する
+    rank = qs[:, None] / 100.0 * np.maximum(n - 1, 0)
+    targets = np.concatenate([np.floor(rank), np.ceil(rank)])
+    n_targets = len(targets)
+
+    # 探索窓 [a, a + width * bins)（順位 × step ごと）
+    a = np.tile(np.where(has, lo, 0.0), (n_targets, 1))
+    width = np.tile(np.where(has & (hi > lo), (np.nextafter(hi, np.inf) - lo) / bins, 1.0), (n_targets, 1))
+    step_offset = np.arange(n_steps) * bins
+    for _ in range(rounds):
+        hist = np.zeros((n_targets, n_steps * bins))
+        below = np.zeros((n_targets, n_steps))
+        for _, block in _step_blocks(values, diff, chunk_rows):
+            for t in range(n_targets):
+                pos = np.floor((block - a[t]) / width[t])  # NaN はどの比較にも入らない
+                below[t] += (pos < 0).sum(axis=0)
+                inside = (pos >= 0) & (pos < bins)
+                idx = (pos + step_offset)[inside].astype(np.int64)
+                hist[t] += np.bincount(idx, minlength=n_steps * bins)
+        cum = below[..., None] + np.cumsum(hist.reshape(n_targets, n_steps, bins), axis=2)
+        # 順位 r の値は、累積個数が r を超える最初のビンにある
+        k = np.minimum((cum <= targets[..., None]).sum(axis=2), bins - 1)
+        a = a + k * width
+        width = width / bins
+    found = a + width * bins / 2
+    v_floor, v_ceil = found[:len(qs)], found[len(qs):]
+    result = v_floor + (rank - np.floor(rank)) * (v_ceil - v_floor)
+    return np.where(has, result, np.nan)
+
+
+def step_color_codes(values, diff=False, levels=254, chunk_rows=65536):
+    """
+    (N_points, N_steps) の値を全ステップ共通の範囲で 0..levels-1 の uint8 に正規化した色バッファを返す。
+    diff=True なら前ステップからの変化量（0th は 0）。NaN は levels（カラーマップの over 色）になる。
+    行ブロック単位で読むので、memmap でも列ごとにファイル全体を読み直さない。
+    戻り値: (codes, vmin, vmax)
+    """
+    n_points, n_steps = values.shape
+
+    # 外れ値に引っ張られないよう、各ステップの 1–99 パーセンタイルから共通範囲を決める
+    p1, p99 = chunked_step_percentiles(values, [1, 99], diff=diff, chunk_rows=chunk_rows)
+    if np.isfinite(p1).any():
+        lo, hi = float(np.nanmin(p1)), float(np.nanmax(p99))
+    else:
+        lo, hi = 0.0, 1.0
+    if diff:
+        lo, hi = -max(abs(lo), abs(hi)), max(abs(lo), abs(hi))
+    if hi <= lo:
+        hi = lo + 1.0
+
+    codes = np.empty((n_points, n_steps), dtype=np.uint8)
+    for r0, block in _step_blocks(values, diff, chunk_rows):
+        scaled = np.clip((block - lo) / (hi - lo) * (levels - 1), 0, levels - 1)
+        codes[r0:r0 + len(block)] = np.where(np.isfinite(block), np.rint(np.nan_to_num(scaled)), levels)
+    return codes, lo, hi
+
+
 def compute_boundary_segments(x, y, grain_id):
     """
     隣接ピクセルの Grain_ID が異なる箇所の「境界エッジ」を線分として返す。
@@ -113,42 +472,31 @@ def compute_boundary_segments(x, y, grain_id):
     return segments
 
 
-def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
+def build_mapper_with_control_figure(data: MapperData, init_mode="click"):
     # 座標・属性
-    x = geo["X_pixel_"].to_numpy()
-    y = geo["Y_pixel_"].to_numpy()
-    subset_id = geo["Subset_ID"].to_numpy()
-    grain_id = geo["Grain_ID"].to_numpy()
+    x = data.x
+    y = data.y
+    subset_id = data.subset_id
+    grain_id = data.grain_id
 
-    # 応力・ひずみ（列順にステップ 0th, 1st, ...）
-    strain_vals = strain.to_numpy(dtype=float)  # shape: (N_points, N_steps)
-    stress_vals = stress.to_numpy(dtype=float)
+    # 応力・ひずみ（列順にステップ 0th, 1st, ...）。コピーせず float32 / memmap のまま参照
+    strain_vals = data.strain  # shape: (N_points, N_steps)
+    stress_vals = data.stress
 
     # ---- Grain_ID を連番コード化（非連続IDにも安定） ----
-    # codes[i] は 0..K-1、unique_grains[codes[i]] が元の Grain_ID
-    codes, unique_grains = pd.factorize(grain_id, sort=True)
+    codes, unique_grains = grain_codes(grain_id)
     K = len(unique_grains)
     # よりカラフルなカラーマップ（turbo）を離散風に使用
-    cmap = plt.get_cmap('turbo')
-    norm = mcolors.Normalize(vmin=0, vmax=max(1, K-1))
+    cmap, norm = grain_color_mapping(K)
 
-    # ---- Grainごとの平均曲線を前計算 ----
-    # grain_id -> インデックス配列
-    grain_to_idx = {}
-    for i, gid in enumerate(grain_id):
-        grain_to_idx.setdefault(gid, []).append(i)
-    # 平均（NaNを無視）
-    grain_mean_strain = {}
-    grain_mean_stress = {}
-    for gid, idxs in grain_to_idx.items():
-        pts = np.array(idxs, dtype=int)
-        grain_mean_strain[gid] = np.nanmean(strain_vals[pts, :], axis=0)
-        grain_mean_stress[gid] = np.nanmean(stress_vals[pts, :], axis=0)
+    # ---- Grainごとの平均曲線を前計算（NaNを無視、行は codes 順） ----
+    grain_mean_strain, _, _ = nan_group_stats(strain_vals, codes, K)
+    grain_mean_stress, _, _ = nan_group_stats(stress_vals, codes, K)
 
     # --- Figures ---
     fig_map, ax_map = plt.subplots()
     fig_curve, ax_curve = plt.subplots()
-    fig_ctrl = plt.figure(figsize=(4.0, 3.6))
+    fig_ctrl = plt.figure(figsize=(4.0, 5.6))
     try:
         fig_ctrl.canvas.manager.set_window_title("Controls")
     except Exception:
@@ -196,9 +544,33 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
         d2 = (x - x0) ** 2 + (y - y0) ** 2
         return int(np.argmin(d2))
 
+    # ---- 領域選択用の空間インデックス（x でソートした並び） ----
+    x_order = np.argsort(x, kind="stable")
+    x_sorted = x[x_order]
+    points_xy = np.column_stack([x, y])
+
+    def rect_members(x0, x1, y0, y1):
+        xmin, xmax = sorted((x0, x1))
+        ymin, ymax = sorted((y0, y1))
+        lo = np.searchsorted(x_sorted, xmin, side="left")
+        hi = np.searchsorted(x_sorted, xmax, side="right")
+        cand = x_order[lo:hi]
+        return np.sort(cand[(y[cand] >= ymin) & (y[cand] <= ymax)])
+
+    def lasso_members(verts):
+        verts = np.asarray(verts)
+        if len(verts) < 3:
+            return np.array([], dtype=int)
+        cand = rect_members(verts[:, 0].min(), verts[:, 0].max(), verts[:, 1].min(), verts[:, 1].max())
+        return cand[MplPath(verts).contains_points(points_xy[cand])]
+
     # 曲線モード状態
-    curve_mode = ["point"]  # or "grain-avg"
+    curve_mode = ["point"]  # or "grain-avg", "region-rect", "region-lasso"
     mode = [init_mode]      # "click" or "hover"
+    region_modes = ("region-rect", "region-lasso")
+    rect_press = [None]     # 矩形ドラッグ開始点（ドラッグ中のライブ更新用）
+    lasso_verts = [None]    # 投げ縄ドラッグ中の頂点（ドラッグ中のライブ更新用）
+    last_region_update = [0.0]
 
     # 応力-ひずみ曲線の更新（色をマップと一致）
     def update_curve(idx):
@@ -208,8 +580,8 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
         color = cmap(norm(code))
 
         if curve_mode[0] == "grain-avg":
-            s_strain = grain_mean_strain[gid]
-            s_stress = grain_mean_stress[gid]
+            s_strain = grain_mean_strain[code]
+            s_stress = grain_mean_stress[code]
             title_extra = " (Grain Average)"
         else:
             s_strain = strain_vals[idx, :]
@@ -222,6 +594,39 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
         ax_curve.plot(s_strain, s_stress, marker="o", color=color, markerfacecolor=color)
         fig_curve.canvas.draw_idle()
 
+    # 領域の平均 ± std 曲線（NaNを無視）
+    def update_region_curve(members, live=False):
+        ax_curve.clear()
+        ax_curve.set_xlabel("Strain [-]")
+        ax_curve.set_ylabel("Stress [GPa]")
+        n = len(members)
+        if n > 0:
+            zeros = np.zeros(n, dtype=int)
+            strain_mean, strain_std, _ = nan_group_stats(strain_vals[members], zeros, 1)
+            stress_mean, stress_std, _ = nan_group_stats(stress_vals[members], zeros, 1)
+            ax_curve.errorbar(strain_mean[0], stress_mean[0], xerr=strain_std[0], yerr=stress_std[0],
+                              marker="o", color="k", capsize=2)
+        ax_curve.set_title(f"Stress–Strain curve (Region, n={n}) (mean ± std)")
+        fig_curve.canvas.draw_idle()
+        if live:
+            return  # ドラッグ中はセレクタの blit を崩さないようマップは再描画しない
+        status_text.set_text(f"mode: {mode[0]} | selected: {n} subsets | curve: {curve_mode[0]}")
+        fig_map.canvas.draw_idle()
+
+    def on_rect_select(eclick, erelease):
+        rect_press[0] = None
+        if None in (eclick.xdata, eclick.ydata, erelease.xdata, erelease.ydata):
+            return
+        update_region_curve(rect_members(eclick.xdata, erelease.xdata, eclick.ydata, erelease.ydata))
+
+    def on_lasso_select(verts):
+        update_region_curve(lasso_members(verts))
+
+    rect_selector = RectangleSelector(ax_map, on_rect_select, useblit=True)
+    lasso_selector = LassoSelector(ax_map, on_lasso_select, useblit=True)
+    rect_selector.set_active(False)
+    lasso_selector.set_active(False)
+
     # 選択点のハイライト更新（色も一致）
     def update_selection(idx):
         code = codes[idx]
@@ -233,6 +638,22 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
 
     # マウス移動イベント（hover 用）
     def on_move(event):
+        if curve_mode[0] in region_modes:
+            # ドラッグ中（ボタンを押している間）は領域内の平均曲線を間引きながら更新
+            if event.button is None or event.inaxes != ax_map or event.xdata is None:
+                return
+            if curve_mode[0] == "region-lasso" and lasso_verts[0] is not None:
+                lasso_verts[0].append((event.xdata, event.ydata))
+            now = time.perf_counter()
+            if now - last_region_update[0] < 0.05:
+                return
+            last_region_update[0] = now
+            if curve_mode[0] == "region-rect" and rect_press[0] is not None:
+                x0, y0 = rect_press[0]
+                update_region_curve(rect_members(x0, event.xdata, y0, event.ydata), live=True)
+            elif curve_mode[0] == "region-lasso" and lasso_verts[0] is not None:
+                update_region_curve(lasso_members(lasso_verts[0]), live=True)
+            return
         if mode[0] != "hover":
             return
         if event.inaxes != ax_map:
@@ -245,6 +666,13 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
 
     # クリックイベント（click 用）
     def on_click(event):
+        if curve_mode[0] in region_modes:
+            if event.inaxes == ax_map and event.xdata is not None:
+                if curve_mode[0] == "region-rect":
+                    rect_press[0] = (event.xdata, event.ydata)
+                else:
+                    lasso_verts[0] = [(event.xdata, event.ydata)]
+            return
         if mode[0] != "click":
             return
         if event.inaxes != ax_map:
@@ -255,6 +683,11 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
         update_selection(idx)
         update_curve(idx)
 
+    # ボタンを離したらドラッグ状態を解除（クリックだけでセレクタが onselect を呼ばない場合も）
+    def on_release(event):
+        rect_press[0] = None
+        lasso_verts[0] = None
+
     # キーイベントでモード切替
     def on_key(event):
         if event.key == "h":
@@ -268,10 +701,74 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
 
     fig_map.canvas.mpl_connect("motion_notify_event", on_move)
     fig_map.canvas.mpl_connect("button_press_event", on_click)
+    fig_map.canvas.mpl_connect("button_release_event", on_release)
     fig_map.canvas.mpl_connect("key_press_event", on_key)
 
+    # ---- ステップごとの色分け（stress / strain / 変化量） ----
+    # 値は uint8 の色バッファとして量ごとに1回だけ作り、スライダー操作では set_array で差し替える
+    color_by = ["Grain_ID"]
+    step = [0]
+    color_buffers = {}   # label -> (codes (N, N_steps) uint8, vmin, vmax)
+    step_levels = 254
+    step_cmaps = {
+        "stress": plt.get_cmap('viridis').resampled(step_levels).with_extremes(over='lightgray'),
+        "strain": plt.get_cmap('viridis').resampled(step_levels).with_extremes(over='lightgray'),
+        "Δstress": plt.get_cmap('coolwarm').resampled(step_levels).with_extremes(over='lightgray'),
+        "Δstrain": plt.get_cmap('coolwarm').resampled(step_levels).with_extremes(over='lightgray'),
+    }
+    step_sources = {"stress": (stress_vals, False), "strain": (strain_vals, False),
+                    "Δstress": (stress_vals, True), "Δstrain": (strain_vals, True)}
+
+    def get_color_buffer(label):
+        if label not in color_buffers:
+            values, diff = step_sources[label]
+            color_buffers[label] = step_color_codes(values, diff=diff, levels=step_levels)
+        return color_buffers[label]
+
+    def apply_color_by(label):
+        """色分けの種類を切り替える（カラーバーも更新するので全体を再描画）"""
+        color_by[0] = label
+        if label == "Grain_ID":
+            sc.set_array(codes)
+            sc.set_cmap(cmap)
+            sc.set_norm(norm)
+            sc.set_alpha(0.9)
+            cbar.update_normal(sc)
+            cbar.set_label("Grain_ID")
+            if K <= 15:
+                cbar.set_ticks(np.linspace(0, K-1, K))
+                cbar.set_ticklabels([str(g) for g in unique_grains])
+            ax_map.set_title("Grain_ID map")
+        else:
+            buf, vmin, vmax = get_color_buffer(label)
+            sc.set_cmap(step_cmaps[label])
+            sc.set_norm(mcolors.Normalize(vmin=0, vmax=step_levels - 1))
+            sc.set_array(buf[:, step[0]])
+            sc.set_alpha(1.0)  # 不透明にして blit で上書き描画できるようにする
+            cbar.update_normal(sc)
+            tick_vals = np.linspace(vmin, vmax, 5)
+            cbar.set_ticks(np.linspace(0, step_levels - 1, 5))
+            cbar.set_ticklabels([f"{v:.3g}" for v in tick_vals])
+            cbar.set_label(label)
+            ax_map.set_title(f"{label} map (step: {data.steps[step[0]]})")
+        fig_map.canvas.draw_idle()
+
+    def blit_step():
+        """スライダー操作中はマップの点だけ描き直して blit（図全体は再描画しない）"""
+        buf, _, _ = color_buffers[color_by[0]]
+        sc.set_array(buf[:, step[0]])
+        canvas = fig_map.canvas
+        if not getattr(canvas, "supports_blit", False) or canvas.get_renderer() is None:
+            canvas.draw_idle()
+            return
+        ax_map.draw_artist(sc)
+        if boundary_artist.get_visible():
+            ax_map.draw_artist(boundary_artist)
+        ax_map.draw_artist(sel_sc)
+        canvas.blit(ax_map.bbox)
+
     # ---- Control figure ----
-    ax_radio = fig_ctrl.add_axes([0.12, 0.62, 0.76, 0.30])  # Click/Hover
+    ax_radio = fig_ctrl.add_axes([0.12, 0.78, 0.76, 0.19])  # Click/Hover
     radio = RadioButtons(ax_radio, ('click', 'hover'), active=0 if init_mode=='click' else 1)
     def on_radio_mode(label):
         mode[0] = label
@@ -279,23 +776,49 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
         fig_map.canvas.draw_idle()
     radio.on_clicked(on_radio_mode)
 
-    ax_checks = fig_ctrl.add_axes([0.12, 0.12, 0.35, 0.35])  # Boundaries
+    ax_checks = fig_ctrl.add_axes([0.12, 0.50, 0.35, 0.24])  # Boundaries
     checks = CheckButtons(ax_checks, ('Boundaries',), (True,))
     def on_check(label):
         boundary_artist.set_visible(not boundary_artist.get_visible())
         fig_map.canvas.draw_idle()
     checks.on_clicked(on_check)
 
-    ax_curve_mode = fig_ctrl.add_axes([0.55, 0.12, 0.33, 0.35])  # Curve Mode
-    radio_curve = RadioButtons(ax_curve_mode, ('point', 'grain-avg'), active=0)
+    ax_curve_mode = fig_ctrl.add_axes([0.50, 0.44, 0.45, 0.32])  # Curve Mode
+    radio_curve = RadioButtons(ax_curve_mode, ('point', 'grain-avg', 'region-rect', 'region-lasso'), active=0)
     def on_radio_curve(label):
         curve_mode[0] = label
+        rect_selector.set_active(label == "region-rect")
+        lasso_selector.set_active(label == "region-lasso")
+        rect_press[0] = None
+        lasso_verts[0] = None
         status_text.set_text(f"mode: {mode[0]} | selected: None | curve: {curve_mode[0]}")
         fig_map.canvas.draw_idle()
     radio_curve.on_clicked(on_radio_curve)
 
+    ax_color_by = fig_ctrl.add_axes([0.12, 0.13, 0.76, 0.27])  # Color by
+    radio_color = RadioButtons(ax_color_by, ('Grain_ID', 'stress', 'strain', 'Δstress', 'Δstrain'), active=0)
+    radio_color.on_clicked(apply_color_by)
+
+    ax_step = fig_ctrl.add_axes([0.22, 0.04, 0.56, 0.05])  # Step scrubber
+    n_steps = len(data.steps)
+    step_slider = Slider(ax_step, "Step", 0, max(1, n_steps - 1), valinit=0, valstep=1)
+    step_slider.valtext.set_text(str(data.steps[0]) if n_steps else "")
+    def on_step(val):
+        step[0] = min(int(val), n_steps - 1)
+        step_slider.valtext.set_text(str(data.steps[step[0]]))
+        if color_by[0] != "Grain_ID":
+            blit_step()
+    step_slider.on_changed(on_step)
+
+    def on_ctrl_release(event):
+        # スクラブ終了時にタイトル・枠線を含めて描き直す
+        if color_by[0] != "Grain_ID":
+            ax_map.set_title(f"{color_by[0]} map (step: {data.steps[step[0]]})")
+            fig_map.canvas.draw_idle()
+    fig_ctrl.canvas.mpl_connect("button_release_event", on_ctrl_release)
+
     # 初期選択
-    if len(geo) > 0:
+    if len(x) > 0:
         update_selection(0)
         update_curve(0)
 
@@ -303,10 +826,137 @@ def build_mapper_with_control_figure(geo, strain, stress, init_mode="click"):
     plt.show()
 
 
+def grain_curves_frame(data: MapperData):
+    """Grain ごとの mean/std 曲線を long 形式（Grain_ID × step）の DataFrame で返す"""
+    codes, unique_grains = grain_codes(data.grain_id)
+    K = len(unique_grains)
+    strain_mean, strain_std, n_strain = nan_group_stats(data.strain, codes, K)
+    stress_mean, stress_std, n_stress = nan_group_stats(data.stress, codes, K)
+    n_steps = len(data.steps)
+    return pd.DataFrame({
+        "Grain_ID": np.repeat(unique_grains, n_steps),
+        "step": np.tile(data.steps, K),
+        "strain_mean": strain_mean.ravel(),
+        "strain_std": strain_std.ravel(),
+        "stress_mean": stress_mean.ravel(),
+        "stress_std": stress_std.ravel(),
+        "n_points": np.minimum(n_strain, n_stress).ravel(),
+    })
+
+
+def point_curves_frame(data: MapperData, subset_ids=None):
+    """指定 Subset_ID（None なら全点）の曲線を long 形式（Subset_ID × step）の DataFrame で返す"""
+    if subset_ids is None:
+        rows = np.arange(len(data.subset_id))
+    else:
+        rows = np.flatnonzero(np.isin(data.subset_id, subset_ids))
+    n_steps = len(data.steps)
+    return pd.DataFrame({
+        "Subset_ID": np.repeat(data.subset_id[rows], n_steps),
+        "Grain_ID": np.repeat(data.grain_id[rows], n_steps),
+        "step": np.tile(data.steps, len(rows)),
+        "strain": np.asarray(data.strain[rows]).ravel(),
+        "stress": np.asarray(data.stress[rows]).ravel(),
+    })
+
+
+def write_table(df, path_stem: Path, fmt="csv"):
+    if fmt == "parquet":
+        path = path_stem.with_suffix(".parquet")
+        df.to_parquet(path, index=False)
+    else:
+        path = path_stem.with_suffix(".csv")
+        df.to_csv(path, index=False)
+    print(f"保存しました: {path}")
+    return path
+
+
+def render_grain_plot(task):
+    """1 Grain の平均 ± std 曲線を画像に保存する（pyplot を使わず Agg で描画）"""
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(5, 4))
+    ax = fig.subplots()
+    color = task["color"]
+    ax.errorbar(task["strain_mean"], task["stress_mean"],
+                xerr=task["strain_std"], yerr=task["stress_std"],
+                marker="o", color=color, markerfacecolor=color, capsize=2)
+    ax.set_title(f"Stress–Strain curve (Grain_ID={task['grain_id']}, n={task['n_points']}) (Grain Average)")
+    ax.set_xlabel("Strain [-]")
+    ax.set_ylabel("Stress [GPa]")
+    fig.savefig(task["path"], dpi=task["dpi"], bbox_inches="tight")
+    return task["path"]
+
+
+def _init_headless_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def render_grain_plots(grain_df, out_dir: Path, max_workers=None, dpi=150):
+    """grain_curves_frame の結果から Grain ごとの画像をプロセスプールで並列に保存する"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    unique_grains = grain_df["Grain_ID"].unique()
+    cmap, norm = grain_color_mapping(len(unique_grains))
+    tasks = []
+    for code, (gid, g) in enumerate(grain_df.groupby("Grain_ID", sort=True)):
+        tasks.append({
+            "grain_id": gid,
+            "n_points": int(g["n_points"].max()),
+            "color": cmap(norm(code)),
+            "strain_mean": g["strain_mean"].to_numpy(),
+            "strain_std": g["strain_std"].to_numpy(),
+            "stress_mean": g["stress_mean"].to_numpy(),
+            "stress_std": g["stress_std"].to_numpy(),
+            "path": out_dir / f"grain_{gid}.png",
+            "dpi": dpi,
+        })
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_headless_worker) as ex:
+        list(ex.map(render_grain_plot, tasks, chunksize=16))
+    print(f"{len(tasks)} 個の Grain 曲線画像を保存しました: {out_dir}")
+
+
+def run_batch(data: MapperData, out_dir: Path, subset_ids=None, fmt="csv",
+              plots=True, max_workers=None, dpi=150):
+    """GUI を使わずに Grain 平均/std 曲線と指定点の曲線を書き出し、Grain ごとの画像を保存する"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    grain_df = grain_curves_frame(data)
+    write_table(grain_df, out_dir / "grain_curves", fmt)
+    if subset_ids is not None:
+        write_table(point_curves_frame(data, None if subset_ids == "all" else subset_ids),
+                    out_dir / "point_curves", fmt)
+    if plots:
+        render_grain_plots(grain_df, out_dir / "grain_plots", max_workers=max_workers, dpi=dpi)
+
+
+def parse_points(text):
+    """--points の値: 'all' またはカンマ区切りの Subset_ID"""
+    if not text:
+        return None
+    if text.strip().lower() == "all":
+        return "all"
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", type=str, default="",
-                        help="Excel file path. 空の場合はダイアログで選択")
+                        help="Excel / .mat ファイル、.mat のフォルダ、または *.mapper_cache のパス。空の場合はダイアログで選択")
+    parser.add_argument("--mat-map", type=str, default="",
+                        help=".mat 変数名の対応を書いた JSON（キー: x, y, subset_id, grain_id, strain, stress, steps）")
+    parser.add_argument("--cache", action="store_true",
+                        help="Excel の隣にバイナリキャッシュ (*.mapper_cache) を作り、memmap で読み込む")
+    parser.add_argument("--batch", action="store_true",
+                        help="GUI を開かずに Grain 平均/std 曲線・指定点の曲線・Grain ごとの画像を書き出す")
+    parser.add_argument("--out", type=str, default="",
+                        help="--batch の出力フォルダ。空の場合は <Excel名>_curves")
+    parser.add_argument("--points", type=str, default="",
+                        help="--batch で書き出す点の Subset_ID（カンマ区切り）または all")
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv",
+                        help="--batch の表の出力形式. Default: csv")
+    parser.add_argument("--no-plots", action="store_true",
+                        help="--batch で Grain ごとの画像を保存しない")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="--batch の画像保存に使うプロセス数（未指定なら CPU 数）")
     parser.add_argument("--mode", type=str, choices=["click", "hover"], default="hover",
                         help="Interaction mode (click or hover). Default: click")
     args = parser.parse_args()
@@ -317,11 +967,17 @@ def main():
     if (xlsx_path is None) or (not xlsx_path.exists()):
         chosen = choose_excel_via_dialog(initial=Path.cwd())
         if chosen is None:
-            raise FileNotFoundError("Excel ファイルが選択されませんでした。--file で直接指定も可能です。")
+            raise FileNotFoundError("Excel / MAT ファイルが選択されませんでした。--file で直接指定も可能です。")
         xlsx_path = chosen.resolve()
 
-    geo, strain, stress = load_data(xlsx_path)
-    build_mapper_with_control_figure(geo, strain, stress, init_mode=args.mode)
+    mat_mapping = json.loads(Path(args.mat_map).read_text(encoding="utf-8")) if args.mat_map else None
+    data = load_mapper_data(xlsx_path, use_cache=args.cache, mat_mapping=mat_mapping)
+    if args.batch:
+        out_dir = Path(args.out).expanduser() if args.out else xlsx_path.with_name(f"{xlsx_path.stem}_curves")
+        run_batch(data, out_dir, subset_ids=parse_points(args.points), fmt=args.format,
+                  plots=not args.no_plots, max_workers=args.workers)
+        return
+    build_mapper_with_control_figure(data, init_mode=args.mode)
 
 
 if __name__ == "__main__":